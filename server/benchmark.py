@@ -0,0 +1,225 @@
+# Benchmarks of graph construction, serialization and solving on synthetic graphs
+# Runs every combination of the given node counts, edge densities, frame counts and noise levels, and prints the results as JSON
+# Every case is run twice on identical graphs: once for wall times and accuracy, and once under tracemalloc for peak memory,
+# since tracing slows down every allocation
+#
+# Example:
+#   python benchmark.py --nodes 4 16 64 --degree 2 4 --frames 100 1000 --noise 0 0.01 --output results.json
+
+import argparse
+import itertools
+import json
+import platform
+import time
+import tracemalloc
+import numpy as np
+
+from graphs import TestTransformationGraph
+from solver import LoopClosureSolver, HandEyeSolver, BundleAdjustmentSolver, UNKNOWN_TYPES
+from tools import se3_exp, se3_log, invert_rigid_transform
+
+# Dictionary of solver name to (solver class, types of the edges it solves)
+SOLVERS = {
+    "hand-eye": (HandEyeSolver, ("rigid-unknown",)),
+    "loop-closure": (LoopClosureSolver, ("non-rigid-unknown",)),
+    "bundle-adjustment": (BundleAdjustmentSolver, UNKNOWN_TYPES),
+}
+
+def generate_edges(num_nodes: int, degree: float, unknown_fraction: float, rigid_fraction: float, noise: float, rng: np.random.Generator) -> list[tuple[int, int, str, float]]:
+    """Generate a random connected graph: a random spanning tree plus random extra edges up to the average degree
+
+    Parameters:
+    num_nodes (int): Number of nodes
+    degree (float): Average number of edges per node
+    unknown_fraction (float): Fraction of edges that are unknown
+    rigid_fraction (float): Fraction of edges that are rigid
+    noise (float): Noise of every edge
+    rng (np.random.Generator): Random generator
+
+    Returns:
+    list[tuple[int, int, str, float]]: List of edges, where each edge is a tuple of (node1, node2, type, noise)
+    """
+    order = rng.permutation(num_nodes)
+    pairs = {tuple(sorted((int(order[i]), int(order[rng.integers(i)])))) for i in range(1, num_nodes)}
+    target = min(int(round(degree * num_nodes / 2)), num_nodes * (num_nodes - 1) // 2)
+    while len(pairs) < target:
+        node1, node2 = rng.choice(num_nodes, 2, replace=False)
+        pairs.add((int(min(node1, node2)), int(max(node1, node2))))
+    edges = []
+    for (node1, node2) in sorted(pairs):
+        rigid = "rigid" if rng.random() < rigid_fraction else "non-rigid"
+        known = "unknown" if rng.random() < unknown_fraction else "known"
+        edges.append((node1, node2, f"{rigid}-{known}", noise))
+    return edges
+
+def add_noise(graph: TestTransformationGraph, noise: float, rng: np.random.Generator):
+    """Perturb every known edge by a random twist with the given standard deviation
+
+    Parameters:
+    graph (TestTransformationGraph): Graph
+    noise (float): Standard deviation of every twist component
+    rng (np.random.Generator): Random generator
+    """
+    if noise == 0:
+        return
+    for (node1, node2, edge_type, _) in graph.get_all_edges():
+        if edge_type not in UNKNOWN_TYPES:
+            graph.set_edge_frames((node1, node2), graph[node1, node2, :] @ se3_exp(rng.normal(scale=noise, size=(graph.num_frames, 6))))
+
+def measure_accuracy(graph: TestTransformationGraph, edge_types: tuple[str, ...]) -> dict:
+    """Compare the unknown edges of a solved graph to the ground truth
+
+    Parameters:
+    graph (TestTransformationGraph): Solved graph
+    edge_types (tuple[str, ...]): Types of the edges to compare
+
+    Returns:
+    dict: Fraction of solved edge frames, and mean and max rotation (radians) and translation errors over them
+    """
+    rotation_errors = []
+    translation_errors = []
+    total = 0
+    for (node1, node2, edge_type, _) in graph.get_all_edges():
+        if edge_type not in edge_types:
+            continue
+        truth = invert_rigid_transform(graph.world_transforms[node1]) @ graph.world_transforms[node2]
+        solved = graph[node1, node2, :]
+        total += graph.num_frames
+        valid = ~np.isnan(solved).any(axis=(-2, -1))
+        error = invert_rigid_transform(solved[valid]) @ truth[valid]
+        rotation_errors.append(np.linalg.norm(se3_log(error)[:, :3], axis=-1))
+        translation_errors.append(np.linalg.norm(error[:, :3, 3], axis=-1))
+    rotation_errors = np.concatenate(rotation_errors) if len(rotation_errors) > 0 else np.zeros(0)
+    translation_errors = np.concatenate(translation_errors) if len(translation_errors) > 0 else np.zeros(0)
+    def summary(errors):
+        return {"mean": float(errors.mean()), "max": float(errors.max())} if len(errors) > 0 else None
+    return {
+        "solved_fraction": len(rotation_errors) / total if total > 0 else None,
+        "rotation_error": summary(rotation_errors),
+        "translation_error": summary(translation_errors),
+    }
+
+def measure(function, traced: bool) -> tuple[object, float]:
+    """Run a function, measuring either its wall time or its peak traced memory
+
+    Parameters:
+    function (Callable[[], object]): Function to run
+    traced (bool): Whether to measure memory instead of time
+
+    Returns:
+    tuple[object, float]: Tuple of (result, seconds or peak bytes)
+    """
+    if not traced:
+        start = time.perf_counter()
+        result = function()
+        return result, time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        result = function()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_pass(result: dict, make_graph, frames: int, args: argparse.Namespace, traced: bool):
+    """Run construction, serialization and the solvers of a case once, on a new graph
+
+    Parameters:
+    result (dict): Results of the case to add to
+    make_graph (Callable[[], TestTransformationGraph]): Function that builds the graph, the same one on every call
+    frames (int): Number of frames
+    args (argparse.Namespace): Command line arguments
+    traced (bool): Whether to measure peak memory, otherwise wall times and accuracy are measured
+    """
+    key = "peak_bytes" if traced else "seconds"
+    graph, result["construction"][key] = measure(make_graph, traced)
+    if frames <= args.max_serialization_frames:
+        _, result.setdefault("serialization", dict())[key] = measure(graph.to_dict, traced)
+    for name in args.solvers:
+        solver_class, edge_types = SOLVERS[name]
+        solver = solver_class(graph) if name == "bundle-adjustment" else solver_class(graph, max_path_length=args.max_path_length)
+        solver_result = result["solvers"].setdefault(name, dict())
+        _, solver_result[key] = measure(solver.solve, traced)
+        if not traced:
+            solver_result["frames_per_second"] = frames / solver_result["seconds"]
+            # Solvers run in order on the same graph, later ones starting from the edges solved by earlier ones, so each
+            # solver is scored right after it runs, on the edges it solves
+            solver_result["accuracy"] = measure_accuracy(graph, edge_types)
+
+def run_case(num_nodes: int, degree: float, edges: list[tuple[int, int, str, float]], frames: int, noise: float, seed: int, noise_seed: int, args: argparse.Namespace) -> dict:
+    """Benchmark one combination of parameters, on the graph given by the edges and seeds, so repeats run the same graph
+
+    Parameters:
+    num_nodes (int): Number of nodes
+    degree (float): Average number of edges per node, as reported
+    edges (list[tuple[int, int, str, float]]): Edges, see generate_edges
+    frames (int): Number of frames
+    noise (float): Standard deviation of the noise added to known edges
+    seed (int): Seed of the ground truth transforms
+    noise_seed (int): Seed of the noise added to known edges
+    args (argparse.Namespace): Command line arguments
+
+    Returns:
+    dict: Results of the case
+    """
+    def make_graph():
+        graph = TestTransformationGraph(num_nodes, edges, frames, seed, args.compact)
+        add_noise(graph, noise, np.random.default_rng(noise_seed))
+        return graph
+
+    result = {
+        "nodes": num_nodes,
+        "degree": degree,
+        "edges": len(edges),
+        "frames": frames,
+        "noise": noise,
+        "construction": dict(),
+        "solvers": dict(),
+    }
+    run_pass(result, make_graph, frames, args, traced=False)
+    run_pass(result, make_graph, frames, args, traced=True)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark graph construction, serialization and solving on synthetic graphs")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[4, 16, 64], help="Node counts")
+    parser.add_argument("--degree", type=float, nargs="+", default=[2, 4], help="Average number of edges per node")
+    parser.add_argument("--frames", type=int, nargs="+", default=[100, 1000], help="Frame counts")
+    parser.add_argument("--noise", type=float, nargs="+", default=[0, 0.01], help="Standard deviation of the noise added to known edges")
+    parser.add_argument("--unknown", type=float, default=0.2, help="Fraction of unknown edges")
+    parser.add_argument("--rigid", type=float, default=0.2, help="Fraction of rigid edges")
+    parser.add_argument("--solvers", nargs="+", choices=list(SOLVERS), default=["hand-eye", "loop-closure"], help="Solvers to run, in order")
+    parser.add_argument("--max-path-length", type=int, default=6, help="Maximum number of edges in the paths searched by the loop closure and hand-eye solvers, as path enumeration is exponential in dense graphs")
+    parser.add_argument("--compact", action="store_true", help="Use compact pose storage")
+    parser.add_argument("--max-serialization-frames", type=int, default=1000, help="Skip serialization for cases with more frames than this")
+    parser.add_argument("--repeats", type=int, default=1, help="Number of runs of every case, all on the same random graph")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random graphs")
+    parser.add_argument("--output", help="File to write the JSON results to, defaults to stdout")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    cases = []
+    for (num_nodes, degree, frames, noise) in itertools.product(args.nodes, args.degree, args.frames, args.noise):
+        edges = generate_edges(num_nodes, degree, args.unknown, args.rigid, noise, rng)
+        seed = int(rng.integers(2 ** 32))
+        noise_seed = int(rng.integers(2 ** 32))
+        for repeat in range(args.repeats):
+            case = run_case(num_nodes, degree, edges, frames, noise, seed, noise_seed, args)
+            case["repeat"] = repeat
+            cases.append(case)
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "arguments": vars(args),
+        "cases": cases,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+# Temporal filtering of edge transforms with an error-state extended Kalman filter on SE(3)
+# Each filtered edge has a constant velocity model: its state is a pose T and a body frame velocity twist v, and the true
+# state is T exp(dxi), v + dv with a 12 dimensional error state (dxi, dv) of covariance P. Measurements are poses Z, with
+# the innovation log(T^-1 Z). All edges, or all edges of several recorded sessions, are filtered at once with batched
+# matrix operations, so the cost of a frame does not grow with Python loops over edges.
+
+import numpy as np
+from graphs import TransformationGraph
+from solver import BaseSolver, UNKNOWN_TYPES
+from tools import se3_exp, se3_log, se3_adjoint, invert_rigid_transform
+
+class SE3KalmanFilter(object):
+    """Batched error-state Kalman filter with a constant velocity model, for a fixed number of poses.
+
+    Twists are in (omega, rho) order, and time is measured in frames. Noise is given as standard deviations, the process
+    noise being that of the acceleration per frame, in the same units as the measurement noise per frame.
+    """
+
+    def __init__(self, count: int, process_noise: float=0.01, measurement_noise: float | np.ndarray=0.01, initial_velocity_noise: float=1.0):
+        """Initialize the filter
+
+        Parameters:
+        count (int): Number of poses filtered at once
+        process_noise (float): Standard deviation of the acceleration twist per frame
+        measurement_noise (float | np.ndarray): Standard deviation of the measurements, per pose or the same for all
+        initial_velocity_noise (float): Standard deviation of the velocity when a pose is first measured
+        """
+        self.process_noise = process_noise
+        self.measurement_noise = np.broadcast_to(np.asarray(measurement_noise, dtype=float), (count,)).copy()
+        self.initial_velocity_noise = initial_velocity_noise
+        self.poses = np.full((count, 4, 4), np.nan)
+        self.velocities = np.zeros((count, 6))
+        self.covariances = np.tile(np.eye(12), (count, 1, 1))
+        # Poses are initialized from their first measurement
+        self.initialized = np.zeros(count, dtype=bool)
+
+    def _transition(self, dt: float) -> tuple[np.ndarray, np.ndarray]:
+        """Get the linearized transition of the error state over dt frames, and its process noise
+
+        Parameters:
+        dt (float): Number of frames
+
+        Returns:
+        tuple[np.ndarray, np.ndarray]: Tuple of (transitions (count, 12, 12), process noise (12, 12))
+        """
+        F = np.tile(np.eye(12), (len(self.poses), 1, 1))
+        # The pose error is carried into the frame of the predicted pose, and the velocity error adds to it over time
+        F[:, :6, :6] = se3_adjoint(se3_exp(-self.velocities * dt))
+        F[:, :6, 6:] = dt * np.eye(6)
+        # White noise acceleration
+        Q = self.process_noise ** 2 * np.block([
+            [dt ** 3 / 3 * np.eye(6), dt ** 2 / 2 * np.eye(6)],
+            [dt ** 2 / 2 * np.eye(6), dt * np.eye(6)],
+        ])
+        return F, Q
+
+    def predict(self, dt: float=1.0) -> np.ndarray:
+        """Advance the state of the initialized poses by dt frames
+
+        Parameters:
+        dt (float): Number of frames
+
+        Returns:
+        np.ndarray: Transitions (count, 12, 12) of the error state, as needed by smoothing
+        """
+        F, Q = self._transition(dt)
+        predicted = self.poses @ se3_exp(self.velocities * dt)
+        self.poses = np.where(self.initialized[:, None, None], predicted, self.poses)
+        self.covariances = np.where(self.initialized[:, None, None], F @ self.covariances @ F.transpose(0, 2, 1) + Q, self.covariances)
+        return F
+
+    def update(self, measurements: np.ndarray):
+        """Correct the state with a measurement of every pose, poses with nan measurements are left as predicted
+
+        Parameters:
+        measurements (np.ndarray): Stack of (count, 4, 4) measured poses
+        """
+        measured = ~np.isnan(measurements).any(axis=(-2, -1))
+        variances = self.measurement_noise ** 2
+
+        # Poses measured for the first time start at rest, at the measurement
+        new = measured & ~self.initialized
+        if np.any(new):
+            self.poses[new] = measurements[new]
+            self.velocities[new] = 0
+            self.covariances[new] = 0
+            self.covariances[new, :6, :6] = variances[new, None, None] * np.eye(6)
+            self.covariances[new, 6:, 6:] = self.initial_velocity_noise ** 2 * np.eye(6)
+            self.initialized[new] = True
+
+        update = measured & ~new
+        if not np.any(update):
+            return
+        P = self.covariances[update]
+        innovation = se3_log(invert_rigid_transform(self.poses[update]) @ measurements[update])
+        S = P[:, :6, :6] + variances[update, None, None] * np.eye(6)
+        K = np.linalg.solve(S, P[:, :6, :]).transpose(0, 2, 1)
+        correction = (K @ innovation[..., None])[..., 0]
+        self.poses[update] = self.poses[update] @ se3_exp(correction[:, :6])
+        self.velocities[update] += correction[:, 6:]
+        P = P - K @ P[:, :6, :]
+        self.covariances[update] = (P + P.transpose(0, 2, 1)) / 2
+
+    def step(self, measurements: np.ndarray, dt: float=1.0) -> np.ndarray:
+        """Predict dt frames ahead, then correct with the measurements of the new frame
+
+        Parameters:
+        measurements (np.ndarray): Stack of (count, 4, 4) measured poses, nan where not measured
+        dt (float): Number of frames since the last step
+
+        Returns:
+        np.ndarray: Stack of (count, 4, 4) filtered poses, nan for poses that were never measured
+        """
+        self.predict(dt)
+        self.update(measurements)
+        return self.poses.copy()
+
+    def extrapolate(self, dt: float) -> np.ndarray:
+        """Extrapolate the poses dt frames ahead without changing the state, to hide the latency to viewers
+
+        Parameters:
+        dt (float): Number of frames
+
+        Returns:
+        np.ndarray: Stack of (count, 4, 4) extrapolated poses, nan for poses that were never measured
+        """
+        return self.poses @ se3_exp(self.velocities * dt)
+
+def smooth_poses(measurements: np.ndarray, process_noise: float=0.01, measurement_noise: float | np.ndarray=0.01, initial_velocity_noise: float=1.0) -> np.ndarray:
+    """Smooth recorded poses with the filter forward in time followed by a Rauch-Tung-Striebel pass backward in time.
+    Poses are smoothed independently, so edges of several recorded sessions can be stacked and smoothed at once.
+
+    Parameters:
+    measurements (np.ndarray): Array of (count, frames, 4, 4) measured poses, nan where not measured
+    process_noise (float): Standard deviation of the acceleration twist per frame
+    measurement_noise (float | np.ndarray): Standard deviation of the measurements, per pose or the same for all
+    initial_velocity_noise (float): Standard deviation of the velocity when a pose is first measured
+
+    Returns:
+    np.ndarray: Array of (count, frames, 4, 4) smoothed poses, nan before the first measurement of each pose
+    """
+    count, frames = measurements.shape[:2]
+    kalman = SE3KalmanFilter(count, process_noise, measurement_noise, initial_velocity_noise)
+    predicted_poses = np.empty((frames, count, 4, 4))
+    predicted_velocities = np.empty((frames, count, 6))
+    predicted_covariances = np.empty((frames, count, 12, 12))
+    has_prior = np.empty((frames, count), dtype=bool)
+    transitions = np.empty((frames, count, 12, 12))
+    poses = np.empty((frames, count, 4, 4))
+    velocities = np.empty((frames, count, 6))
+    covariances = np.empty((frames, count, 12, 12))
+
+    # Forward pass, keeping the predicted and filtered states of every frame
+    for frame in range(frames):
+        has_prior[frame] = kalman.initialized
+        transitions[frame] = kalman.predict() if frame > 0 else np.eye(12)
+        predicted_poses[frame] = kalman.poses
+        predicted_velocities[frame] = kalman.velocities
+        predicted_covariances[frame] = kalman.covariances
+        kalman.update(measurements[:, frame])
+        poses[frame] = kalman.poses
+        velocities[frame] = kalman.velocities
+        covariances[frame] = kalman.covariances
+
+    # Backward pass, where the smoothed state of a frame is corrected by the difference between the smoothed and the
+    # predicted state of the next frame. Poses first measured in the next frame have no prediction to correct against.
+    for frame in range(frames - 2, -1, -1):
+        prior = has_prior[frame + 1]
+        if not np.any(prior):
+            continue
+        P = covariances[frame, prior]
+        C = np.linalg.solve(predicted_covariances[frame + 1, prior], transitions[frame + 1, prior] @ P).transpose(0, 2, 1)
+        difference = np.concatenate([
+            se3_log(invert_rigid_transform(predicted_poses[frame + 1, prior]) @ poses[frame + 1, prior]),
+            velocities[frame + 1, prior] - predicted_velocities[frame + 1, prior],
+        ], axis=-1)
+        correction = (C @ difference[..., None])[..., 0]
+        poses[frame, prior] = poses[frame, prior] @ se3_exp(correction[:, :6])
+        velocities[frame, prior] += correction[:, 6:]
+        covariances[frame, prior] = P + C @ (covariances[frame + 1, prior] - predicted_covariances[frame + 1, prior]) @ C.transpose(0, 2, 1)
+    return poses.transpose(1, 0, 2, 3)
+
+def _solved_edge_noise(solver: BaseSolver, edges: list[tuple[int, int]], max_path_length: int=None) -> np.ndarray:
+    """Get the noise of solved edges. An unknown edge that is fused from paths of known edges, as by LoopClosureSolver, has
+    the standard deviation of the fused estimate, sqrt(1 / sum(1 / variance)) over the paths, so it follows the noise of the
+    known edges when that is estimated online. Other edges have their noise in the graph.
+
+    Parameters:
+    solver (BaseSolver): Solver of the graph
+    edges (list[tuple[int, int]]): Edges
+    max_path_length (int): Maximum number of edges in a path, as given to the solver that fuses the paths
+
+    Returns:
+    np.ndarray: Standard deviation of every edge
+    """
+    noise = np.empty(len(edges))
+    for i, edge in enumerate(edges):
+        paths = solver._find_paths(*edge, max_path_length) if solver.graph.get_type(edge) in UNKNOWN_TYPES else []
+        if len(paths) == 0:
+            noise[i] = solver.graph.get_noise(edge)
+            continue
+        noise[i] = np.sqrt(1 / sum(1 / max(solver._path_variance(path), np.finfo(float).eps) for path in paths))
+    return noise
+
+class KalmanFilterSolver(BaseSolver):
+    """Filters solved non-rigid edges frame by frame, replacing them with their filtered poses.
+
+    It must run after the solvers that produce the edges. The filter state of every edge is kept across calls to solve, so
+    solving frame after frame, as in a live session, costs O(1) per frame. Frames without a solution are filled with the
+    prediction of the filter. Unless it is given, the measurement noise of every edge is that of its fused paths, see
+    _solved_edge_noise, read again on every solve as the noise of the known edges may be estimated online.
+    """
+
+    def __init__(self, graph: TransformationGraph, process_noise: float=0.01, measurement_noise: float=None, edge_types: tuple[str, ...]=("non-rigid-unknown",), max_path_length: int=None):
+        """Initialize the solver with a graph.
+
+        Parameters:
+        graph (TransformationGraph): Graph to solve
+        process_noise (float): Standard deviation of the acceleration twist per frame
+        measurement_noise (float): Standard deviation of the solved edges, or None to derive it from the paths of each edge
+        edge_types (tuple[str, ...]): Types of the edges to filter
+        max_path_length (int): Maximum number of edges in the paths of an edge, as given to the solver of the edges
+        """
+        super().__init__(graph)
+        self.measurement_noise = measurement_noise
+        self.max_path_length = max_path_length
+        # Edge ids and endpoints of the filtered edges
+        self.edge_ids = [edge_id for edge_id, (_, _, edge_type, _) in enumerate(graph.get_all_edges()) if edge_type in edge_types]
+        self.edges = [graph.get_all_edges()[edge_id][:2] for edge_id in self.edge_ids]
+        self.filter = SE3KalmanFilter(len(self.edges), process_noise, self._measurement_noise())
+        self._last_frame = None
+
+    def _measurement_noise(self) -> np.ndarray:
+        """Get the measurement noise of every filtered edge, derived again every time as it may be estimated online
+        """
+        if self.measurement_noise is not None:
+            return np.full(len(self.edges), self.measurement_noise)
+        return _solved_edge_noise(self, self.edges, self.max_path_length)
+
+    def _solve(self, start_frame: int, end_frame: int):
+        """Filter the edges for the given frame range, continuing from the frames seen by previous calls.
+
+        Parameters:
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+        """
+        if len(self.edges) == 0:
+            return
+        self.filter.measurement_noise = self._measurement_noise()
+        measurements = np.stack([self.graph[node1, node2, start_frame:end_frame] for (node1, node2) in self.edges], axis=1)
+        filtered = np.empty_like(measurements)
+        for i in range(end_frame - start_frame):
+            # Skipped frames are predicted over
+            dt = 1 if self._last_frame is None else start_frame + i - self._last_frame
+            filtered[i] = self.filter.step(measurements[i], dt)
+            self._last_frame = start_frame + i
+        for (node1, node2), poses in zip(self.edges, filtered.transpose(1, 0, 2, 3)):
+            self.graph[node1, node2, start_frame:end_frame] = poses
+
+    def predict(self, frames_ahead: float) -> np.ndarray:
+        """Predict the filtered edges ahead of the last filtered frame
+
+        Parameters:
+        frames_ahead (float): Number of frames to predict ahead
+
+        Returns:
+        np.ndarray: Stack of (edges, 4, 4) predicted transforms, in the order of edge_ids
+        """
+        return self.filter.extrapolate(frames_ahead)
+
+class KalmanSmootherSolver(BaseSolver):
+    """Smooths solved non-rigid edges of a recorded session, using every frame of the range for every frame, see smooth_poses.
+    """
+
+    def __init__(self, graph: TransformationGraph, process_noise: float=0.01, measurement_noise: float=None, edge_types: tuple[str, ...]=("non-rigid-unknown",), max_path_length: int=None):
+        """Initialize the solver with a graph.
+
+        Parameters:
+        graph (TransformationGraph): Graph to solve
+        process_noise (float): Standard deviation of the acceleration twist per frame
+        measurement_noise (float): Standard deviation of the solved edges, or None to derive it from the paths of each edge, see _solved_edge_noise
+        edge_types (tuple[str, ...]): Types of the edges to smooth
+        max_path_length (int): Maximum number of edges in the paths of an edge, as given to the solver of the edges
+        """
+        super().__init__(graph)
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.max_path_length = max_path_length
+        self.edges = [(node1, node2) for (node1, node2, edge_type, _) in graph.get_all_edges() if edge_type in edge_types]
+
+    def _solve(self, start_frame: int, end_frame: int):
+        """Smooth the edges over the given frame range.
+
+        Parameters:
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+        """
+        if len(self.edges) == 0:
+            return
+        noise = self.measurement_noise
+        if noise is None:
+            noise = _solved_edge_noise(self, self.edges, self.max_path_length)
+        measurements = np.stack([self.graph[node1, node2, start_frame:end_frame] for (node1, node2) in self.edges])
+        for (node1, node2), poses in zip(self.edges, smooth_poses(measurements, self.process_noise, noise)):
+            self.graph[node1, node2, start_frame:end_frame] = poses
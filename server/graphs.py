@@ -16,6 +16,8 @@
 # We will first need to define the type of each edge: "rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"
 # We will also need to define the noise of each edge
 # Then, we create a empty matrix of matrices, where each matrix is a 4x4 transformation matrix
+# Graphs are sparse (a handful of edges per node), so only edges are stored: each edge gets a contiguous block of frames per direction,
+# found through an adjacency index instead of a dense (nodes, nodes, frames, 4, 4) tensor
 
 # === Implementation ===
 # We will create a custom class for the matrix of matrices, we will implement so that it can be indexed by a tuple (node, node)
@@ -40,44 +42,263 @@
 
 # Finally, we can use the graph to solve for the transformations of any node in any frame
 
+import copy
 import json
-import math
-from typing import Literal
+import os
+import pickle
+import struct
+import tempfile
+from collections import deque
+from typing import Iterable, Iterator, Literal
 import numpy as np
-from tools import *
+from tools import generate_random_transforms, calc_relative_transform, invert_rigid_transform, matrices_to_poses, poses_to_matrices, invert_poses
+from instrumentation import NULL_INSTRUMENTATION
 
-# These implementations are used for testing mostly, and online variants will be implemented later that uses only an iterative interface for solving; since in the online case, we will not know the whole graph at once
+# TransformationGraph and TestTransformationGraph hold a whole recording at once and are used for testing and offline solving.
+# StreamingTransformationGraph is the online variant, since in the online case, we will not know the whole graph at once
+
+RIGID_TYPES = ("rigid-known", "rigid-unknown")
+
+# Saved graph files start with these bytes, arrays in them are aligned to pages so they can be memory mapped efficiently
+FILE_MAGIC = b"TFGRAPH\x01"
+PAGE_SIZE = 4096
+
+def _align(offset: int, alignment: int) -> int:
+    """Round an offset up to a multiple of the alignment
+
+    Parameters:
+    offset (int): Offset
+    alignment (int): Alignment
+
+    Returns:
+    int: Aligned offset
+    """
+    return -(-offset // alignment) * alignment
+
+class GraphTopology:
+    """
+    Precomputed index of the static structure of a graph: adjacency lists, rigid groups and cached paths between nodes.
+    The edges of a graph are fixed when it is created, so the index is built once per graph and solvers querying paths every
+    frame do not repeat the search.
+    """
+
+    def __init__(self, graph: "TransformationGraph"):
+        """Build the index
+
+        Parameters:
+        graph (TransformationGraph): Graph to index
+        """
+        # Adjacency lists of (neighbor, type) per node, sorted by neighbor
+        self._neighbors = [tuple((neighbor, graph._types[slot // 2]) for neighbor, slot in sorted(graph._adjacency[node].items())) for node in range(graph.num_nodes)]
+
+        # Rigid groups with union-find over the rigid edges
+        parents = list(range(graph.num_nodes))
+        def find(node: int) -> int:
+            while parents[node] != node:
+                # Path halving
+                parents[node] = parents[parents[node]]
+                node = parents[node]
+            return node
+        for (node1, node2), edge_type in zip(graph._edge_nodes, graph._types):
+            if edge_type in RIGID_TYPES:
+                root1, root2 = find(node1), find(node2)
+                if root1 != root2:
+                    parents[max(root1, root2)] = min(root1, root2)
+        # Groups are numbered in order of their smallest node
+        self._group_ids = []
+        self._groups = []
+        roots = dict()
+        for node in range(graph.num_nodes):
+            root = find(node)
+            if root not in roots:
+                roots[root] = len(self._groups)
+                self._groups.append(set())
+            self._groups[roots[root]].add(node)
+            self._group_ids.append(roots[root])
+
+        self._paths = dict()
+        self._shortest_paths = dict()
+        self._cycles = None
+
+    def get_neighbors(self, node: int) -> tuple[tuple[int, str], ...]:
+        """Get the neighbors of a node
+
+        Parameters:
+        node (int): Node
+
+        Returns:
+        tuple[tuple[int, str], ...]: Tuple of (neighbor, type) pairs
+        """
+        return self._neighbors[node]
+
+    def get_group_id(self, node: int) -> int:
+        """Get the id of the rigid group of a node
+
+        Parameters:
+        node (int): Node
+
+        Returns:
+        int: Group id
+        """
+        return self._group_ids[node]
+
+    @property
+    def groups(self) -> list[set[int]]:
+        """Get the rigid groups, which are the sets of nodes connected by rigid edges
+
+        Returns:
+        list[set[int]]: List of groups, indexed by group id
+        """
+        return self._groups
+
+    def get_cycles(self) -> list[tuple[int, ...]]:
+        """Get a cycle basis of the graph, with one fundamental cycle per edge that is not in a breadth first spanning forest.
+        Every loop of the graph is a combination of these cycles. The result is cached.
+
+        Returns:
+        list[tuple[int, ...]]: List of cycles, where each cycle is a tuple of nodes that starts and ends at the same node
+        """
+        if self._cycles is None:
+            parents = dict()
+            depths = dict()
+            tree_edges = set()
+            for root in range(len(self._neighbors)):
+                if root in parents:
+                    continue
+                parents[root] = None
+                depths[root] = 0
+                queue = deque([root])
+                while len(queue) > 0:
+                    node = queue.popleft()
+                    for (neighbor, _) in self._neighbors[node]:
+                        if neighbor not in parents:
+                            parents[neighbor] = node
+                            depths[neighbor] = depths[node] + 1
+                            tree_edges.add((node, neighbor))
+                            queue.append(neighbor)
+            self._cycles = []
+            for node1 in range(len(self._neighbors)):
+                for (node2, _) in self._neighbors[node1]:
+                    if node1 > node2 or (node1, node2) in tree_edges or (node2, node1) in tree_edges:
+                        continue
+                    # Walk both ends up the tree to their lowest common ancestor
+                    path1, path2 = [node1], [node2]
+                    while path1[-1] != path2[-1]:
+                        if depths[path1[-1]] >= depths[path2[-1]]:
+                            path1.append(parents[path1[-1]])
+                        else:
+                            path2.append(parents[path2[-1]])
+                    # node1 -> node2 over the edge, then up to the ancestor and back down to node1
+                    self._cycles.append(tuple([node1] + path2 + path1[-2::-1]))
+        return self._cycles
+
+    def find_paths(self, start: int, end: int, edge_types: tuple[str, ...], max_length: int=None) -> list[tuple[int, ...]]:
+        """Find all simple paths between two nodes using depth first search. Results are cached.
+
+        Parameters:
+        start (int): Node to start from
+        end (int): Node to end at
+        edge_types (tuple[str, ...]): Edge types that paths may use
+        max_length (int): Maximum number of edges in a path, or None for no limit
+
+        Returns:
+        list[tuple[int, ...]]: List of paths, where each path is a tuple of nodes from start to end
+        """
+        key = (start, end, tuple(edge_types), max_length)
+        if key not in self._paths:
+            paths = []
+            stack = [(start,)]
+            while len(stack) > 0:
+                path = stack.pop()
+                if max_length is not None and len(path) > max_length:
+                    continue
+                for (neighbor, edge_type) in self._neighbors[path[-1]]:
+                    if edge_type not in edge_types or neighbor in path:
+                        continue
+                    if neighbor == end:
+                        paths.append(path + (neighbor,))
+                    else:
+                        stack.append(path + (neighbor,))
+            self._paths[key] = paths
+        return self._paths[key]
+
+    def shortest_path(self, start: int, end: int, edge_types: tuple[str, ...]) -> tuple[int, ...]:
+        """Find a path with the fewest edges between two nodes using breadth first search. Results are cached.
+
+        Parameters:
+        start (int): Node to start from
+        end (int): Node to end at
+        edge_types (tuple[str, ...]): Edge types that the path may use
+
+        Returns:
+        tuple[int, ...]: Tuple of nodes from start to end, or None if the nodes are not connected
+        """
+        key = (start, end, tuple(edge_types))
+        if key not in self._shortest_paths:
+            previous = {start: None}
+            queue = deque([start])
+            while len(queue) > 0 and end not in previous:
+                node = queue.popleft()
+                for (neighbor, edge_type) in self._neighbors[node]:
+                    if edge_type in edge_types and neighbor not in previous:
+                        previous[neighbor] = node
+                        queue.append(neighbor)
+            path = None
+            if end in previous:
+                path = [end]
+                while previous[path[-1]] is not None:
+                    path.append(previous[path[-1]])
+                path = tuple(reversed(path))
+            self._shortest_paths[key] = path
+        return self._shortest_paths[key]
 
 class TransformationGraph:
-    def __init__(self, num_nodes: int, edges: list[tuple[int, int, Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"], float]], frames: int=1):
+    # Names of the arrays that have a frame axis, these are left out of the header when saving and of detached copies
+    _frame_arrays = ("_transforms", "_stale")
+    # Instrumentation of the hot paths, replaced by solvers that are instrumented, see BaseSolver.instrument
+    instrumentation = NULL_INSTRUMENTATION
+
+    def __init__(self, num_nodes: int, edges: list[tuple[int, int, Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"], float]], frames: int=1, compact: bool=False, dtype: np.dtype=np.float64):
         """Initialize the transformation graph
 
         Parameters:
         num_nodes (int): Number of nodes in the graph
         edges (list[tuple[int, int, Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"], float]]): List of edges, where each edge is a tuple of (node1, node2, type, noise)
         frames (int): Number of frames in the graph
+        compact (bool): Store each transform as a 7 float pose (quaternion and translation) instead of a 4x4 matrix
+        dtype (np.dtype): Type of the stored poses in compact mode, float32 halves the memory again
         """
         if frames < 1:
             raise Exception("Number of frames must be at least 1")
         # TODO: Have better representation of noise. Look into Kalman filters.
 
-        # Create a matrix of matrices
-        self._matrix = np.nan * np.ones((num_nodes, num_nodes, frames, 4, 4))
+        self._num_nodes = num_nodes
 
-        # Create a seperate np object matrix for the edge types, set to None (not np.nan) initially
-        self._types = np.empty((num_nodes, num_nodes), dtype=object)
+        # Edges are stored sparsely. Every edge owns two directed slots, 2 * edge_id for node1 -> node2 and 2 * edge_id + 1 for node2 -> node1,
+        # so the reverse slot of any slot is slot ^ 1. The adjacency index maps node -> {neighbor: slot}.
+        self._adjacency = [dict() for _ in range(num_nodes)]
 
-        # Create a seperate matrix for the noise of each edge
-        self._noise = np.nan * np.ones((num_nodes, num_nodes))
+        # Per edge endpoints, types and noise, indexed by edge id (slot // 2)
+        self._edge_nodes = []
+        self._types = []
+        self._noise = []
 
-        # Set the matrix edge types and noise
+        # Set the edge types and noise
         for edge in edges:
-            # Set edge type
-            self._types[edge[0], edge[1]] = edge[2]
-            self._types[edge[1], edge[0]] = edge[2]
-            # Set noise
-            self._noise[edge[0], edge[1]] = edge[3]
-            self._noise[edge[1], edge[0]] = edge[3]
+            slot = self._adjacency[edge[0]].get(edge[1])
+            if slot is None:
+                # New edge, allocate a pair of slots
+                edge_id = len(self._edge_nodes)
+                self._edge_nodes.append((edge[0], edge[1]))
+                self._types.append(edge[2])
+                self._noise.append(edge[3])
+                self._adjacency[edge[0]][edge[1]] = 2 * edge_id
+                self._adjacency[edge[1]][edge[0]] = 2 * edge_id + 1
+            else:
+                # Redefinition of an existing edge overrides its type and noise
+                self._types[slot // 2] = edge[2]
+                self._noise[slot // 2] = edge[3]
+        self._noise = np.array(self._noise, dtype=float)
 
         # TODO: This should be in test class instead
         # # Validate intra-group edges are rigid
@@ -87,10 +308,50 @@ class TransformationGraph:
         #             if self._types[node1, node2, 0] != "rigid-known" and self._types[node1, node2, 0] != "rigid-unknown":
         #                 raise Exception("Inconsistent edge type in group")
 
-        # Fill the identity matrices
-        for i in range(num_nodes):
-            for j in range(frames):
-                self._matrix[i, i, j] = np.eye(4)
+        # Contiguous per-slot frame arrays, so memory scales with edges × frames instead of nodes² × frames
+        # In compact mode every transform is a (w, x, y, z, tx, ty, tz) pose, converted to and from 4x4 matrices only at the API boundary
+        self._compact = compact
+        pose_shape = (7,) if compact else (4, 4)
+        self._transforms = np.full((2 * len(self._edge_nodes), frames) + pose_shape, np.nan, dtype=dtype if compact else np.float64)
+
+        # Setting a slot only marks the frames of the reverse slot as stale, their inverses are computed on first read
+        self._stale = np.zeros((2 * len(self._edge_nodes), frames), dtype=bool)
+
+        # Incremented on every change of the transforms, so that derived data such as serializations can be cached
+        self._version = 0
+        self._serialization_cache = dict()
+        # Version of the last change of each edge, so that derived data can be invalidated per edge, see WorldPoseResolver
+        self._edge_versions = np.zeros(len(self._edge_nodes), dtype=np.int64)
+
+        # Topology index, built on first use
+        self._topology = None
+
+    def _get_slot(self, node1: int, node2: int) -> int:
+        """Get the storage slot of a directed edge
+
+        Parameters:
+        node1 (int): Node the edge starts from
+        node2 (int): Node the edge ends at
+
+        Returns:
+        int: Slot index into the transform storage
+        """
+        slot = self._adjacency[node1].get(node2)
+        # Throw an error if there is no connection type
+        if slot is None:
+            raise Exception("No connection type defined for edge")
+        return slot
+
+    def _get_frame_index(self, frame: int | slice) -> int | slice | np.ndarray:
+        """Map a frame, or a slice of frames, to its index in the frame axis of the transform storage
+
+        Parameters:
+        frame (int | slice): Frame or slice of frames
+
+        Returns:
+        int | slice | np.ndarray: Index into the frame axis
+        """
+        return frame
 
     def __getitem__(self, key: tuple[int, int, int]) -> np.ndarray:
         """Get the transformation matrix for a given edge and frame
@@ -99,29 +360,115 @@ class TransformationGraph:
         key (tuple[int, int, int]): Tuple of (node1, node2, frame)
 
         Returns:
-        np.ndarray: Transformation matrix
+        np.ndarray: Transformation matrix, which is a copy rather than a view in compact mode
         """
-        # Throw an error if there is no connection type
-        if self._types[key[0], key[1]] == None:
-            raise Exception("No connection type defined for edge")
-        return self._matrix[key[0], key[1], key[2]]
+        slot = self._get_slot(key[0], key[1])
+        frame = self._get_frame_index(key[2])
+        self._resolve_inverses(slot, frame)
+        if self._compact:
+            return poses_to_matrices(self._transforms[slot, frame])
+        return self._transforms[slot, frame]
 
     def __setitem__(self, key: tuple[int, int, int], value: np.ndarray):
-        """Set the transformation matrix for a given edge and frame
+        """Set the transformation matrix for a given edge and frame. The frame may be a slice to set a block of frames at once.
 
         Parameters:
         key (tuple[int, int, int]): Tuple of (node1, node2, frame)
         value (np.ndarray): Transformation matrix
         """
-        # Throw an error if there is no connection type
-        if self._types[key[0], key[1]] == None:
-            raise Exception("No connection type defined for edge")
+        slot = self._get_slot(key[0], key[1])
+        frame = self._get_frame_index(key[2])
 
         # Set the value
-        self._matrix[key[0], key[1], key[2]] = value
+        self._transforms[slot, frame] = matrices_to_poses(np.asarray(value, dtype=float)) if self._compact else value
+        self._stale[slot, frame] = False
+
+        # The inverse is derived when the other direction is read
+        self._stale[slot ^ 1, frame] = True
+        self._version += 1
+        self._edge_versions[slot >> 1] = self._version
+
+    def set_edge_frames(self, key: tuple[int, int], values: np.ndarray, start_frame: int=None):
+        """Set a contiguous block of frames of an edge at once
+
+        Parameters:
+        key (tuple[int, int]): Tuple of (node1, node2)
+        values (np.ndarray): Stack of (frames, 4, 4) transformation matrices
+        start_frame (int): Frame of the first matrix, or None for the first frame of the graph
+        """
+        if start_frame is None:
+            start_frame = self.first_frame
+        self[key[0], key[1], start_frame:start_frame + len(values)] = values
+
+    def get_poses(self, key: tuple[int, int, int]) -> np.ndarray:
+        """Get the compact poses for a given edge and frame, which avoids any conversion in compact mode
+
+        Parameters:
+        key (tuple[int, int, int]): Tuple of (node1, node2, frame)
+
+        Returns:
+        np.ndarray: Pose, or stack of poses, of 7 floats (w, x, y, z, tx, ty, tz)
+        """
+        slot = self._get_slot(key[0], key[1])
+        frame = self._get_frame_index(key[2])
+        self._resolve_inverses(slot, frame)
+        if self._compact:
+            return self._transforms[slot, frame]
+        return matrices_to_poses(self._transforms[slot, frame])
+
+    def get_edge_transforms(self, frame: int) -> np.ndarray:
+        """Get the transforms of every edge, in the node1 -> node2 direction, for a given frame
+
+        Parameters:
+        frame (int): Frame
+
+        Returns:
+        np.ndarray: Stack of (edges, 4, 4) transformation matrices, in edge id order
+        """
+        frame = self._get_frame_index(frame)
+        for slot in 2 * np.flatnonzero(self._stale[0::2, frame]):
+            self._resolve_inverses(slot, frame)
+        if self._compact:
+            return poses_to_matrices(self._transforms[0::2, frame])
+        return self._transforms[0::2, frame]
+
+    def _resolve_inverses(self, slot: int, frame: int | slice | np.ndarray):
+        """Compute the stale frames of a slot from the reverse slot. Transforms are rigid, so this uses the closed form inverse batched across frames.
 
-        # Set the inverse
-        self._matrix[key[1], key[0], key[2]] = np.linalg.inv(value)
+        Parameters:
+        slot (int): Slot index into the transform storage
+        frame (int | slice | np.ndarray): Index into the frame axis
+        """
+        stale = self._stale[slot, frame]
+        if not np.any(stale):
+            return
+        if np.ndim(stale) == 0:
+            positions = frame
+        else:
+            positions = np.arange(self._stale.shape[1])[frame][stale]
+        invert = invert_poses if self._compact else invert_rigid_transform
+        with self.instrumentation.stage("inverse"):
+            self._transforms[slot, positions] = invert(self._transforms[slot ^ 1, positions])
+            self._stale[slot, positions] = False
+
+    def get_frame_range(self, start_frame: int=None, end_frame: int=-1) -> tuple[int, int]:
+        """Resolve a frame range, where a start frame of None means the first frame of the graph and an end frame of -1 means up to and including the last frame.
+
+        Parameters:
+        start_frame (int): First frame, or None for the first frame of the graph
+        end_frame (int): Frame after the last frame, or -1 for the end of the graph
+
+        Returns:
+        tuple[int, int]: Tuple of (start_frame, end_frame), with end_frame exclusive
+        """
+        last_frame = self.first_frame + self.num_frames
+        if start_frame is None:
+            start_frame = self.first_frame
+        if end_frame == -1:
+            end_frame = last_frame
+        if start_frame < self.first_frame or end_frame > last_frame or start_frame >= end_frame:
+            raise Exception("Invalid frame range")
+        return start_frame, end_frame
 
     def get_type(self, key: tuple[int, int]) -> Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"]:
         """Get the type of a given edge
@@ -130,9 +477,12 @@ class TransformationGraph:
         key (tuple[int, int]): Tuple of (node1, node2)
 
         Returns:
-        Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"]: Type of the edge
+        Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"]: Type of the edge, or None if there is no edge
         """
-        return self._types[key[0], key[1]]
+        slot = self._adjacency[key[0]].get(key[1])
+        if slot is None:
+            return None
+        return self._types[slot // 2]
 
     def get_noise(self, key: tuple[int, int]) -> float:
         """Get the noise of a given edge
@@ -141,9 +491,23 @@ class TransformationGraph:
         key (tuple[int, int]): Tuple of (node1, node2)
 
         Returns:
-        float: Noise of the edge
+        float: Noise of the edge, or nan if there is no edge
         """
-        return self._noise[key[0], key[1]]
+        slot = self._adjacency[key[0]].get(key[1])
+        if slot is None:
+            return np.nan
+        return self._noise[slot // 2]
+
+    def set_noise(self, key: tuple[int, int], noise: float):
+        """Set the noise of a given edge, as done by solvers that estimate noise online
+
+        Parameters:
+        key (tuple[int, int]): Tuple of (node1, node2)
+        noise (float): Noise of the edge
+        """
+        self._noise[self._get_slot(key[0], key[1]) // 2] = noise
+        # The noise is part of the serialized edges
+        self._version += 1
 
     def get_nodes(self) -> list[int]:
         """Get the list of nodes in the graph
@@ -151,7 +515,7 @@ class TransformationGraph:
         Returns:
         list[int]: List of nodes
         """
-        return list(range(self._matrix.shape[0]))
+        return list(range(self._num_nodes))
 
     def get_edges(self, node:int) -> list[tuple[int, Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"], float]]:
         """Get the list of edges for a given node
@@ -162,14 +526,101 @@ class TransformationGraph:
         Returns:
         list[tuple[int, Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"], float]]: List of edges, where each edge is a tuple of (node, type, noise)
         """
-        # print(f'Checking edges for node {node}')
-        edges = []
-        for i in range(self._matrix.shape[0]):
-            edge_type = self._types[node, i]
-            if edge_type != None:
-                edges.append((i, self._types[node, i], self._noise[node, i]))
-        # print(f'Found edges {edges}')
-        return edges
+        return [(neighbor, self._types[slot // 2], self._noise[slot // 2]) for neighbor, slot in sorted(self._adjacency[node].items())]
+
+    def get_all_edges(self) -> list[tuple[int, int, Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"], float]]:
+        """Get the list of all edges in the graph
+
+        Returns:
+        list[tuple[int, int, Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"], float]]: List of edges, where each edge is a tuple of (node1, node2, type, noise)
+        """
+        return [(node1, node2, self._types[edge_id], self._noise[edge_id]) for edge_id, (node1, node2) in enumerate(self._edge_nodes)]
+
+    def _detach_frame_arrays(self) -> "TransformationGraph":
+        """Get a shallow copy of the graph without its frame arrays or caches, which is cheap to send to other processes.
+        The frame arrays must be set on the copy before it is used.
+
+        Returns:
+        TransformationGraph: Copy of the graph
+        """
+        detached = copy.copy(self)
+        for name in self._frame_arrays:
+            setattr(detached, name, None)
+        detached._serialization_cache = dict()
+        detached._topology = None
+        detached.instrumentation = NULL_INSTRUMENTATION
+        return detached
+
+    def save(self, path: str):
+        """Save the graph to a file that can be memory mapped by load
+
+        The file starts with the magic bytes, the length of the header and the header, which is a pickle of the graph without
+        its frame arrays plus the layout of the arrays. The raw frame arrays follow, each aligned to a page boundary.
+        The file is written next to the target and then moved over it, so a graph loaded from the same path can be saved back
+        to it: its memory mapped arrays keep reading the previous file until they are released.
+
+        Parameters:
+        path (str): Path of the file
+        """
+        layout = dict()
+        offset = 0
+        for name in self._frame_arrays:
+            array = getattr(self, name)
+            layout[name] = (offset, array.shape, array.dtype.str)
+            offset = _align(offset + array.nbytes, PAGE_SIZE)
+        header = pickle.dumps({"graph": self._detach_frame_arrays(), "arrays": layout})
+        data_start = _align(len(FILE_MAGIC) + 8 + len(header), PAGE_SIZE)
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                f.write(FILE_MAGIC)
+                f.write(struct.pack("<Q", len(header)))
+                f.write(header)
+                for name, (offset, _, _) in layout.items():
+                    f.seek(data_start + offset)
+                    np.ascontiguousarray(getattr(self, name)).tofile(f)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    @staticmethod
+    def load(path: str, mmap_mode: Literal["r", "r+", "c"]="c") -> "TransformationGraph":
+        """Open a graph saved with save, memory mapping its frame arrays so that only the frames that are touched are read.
+        The file contains a pickle, so only open files from trusted sources.
+
+        Parameters:
+        path (str): Path of the file
+        mmap_mode (Literal["r", "r+", "c"]): Mode of np.memmap, "c" keeps changes in memory, "r+" writes them to the file and "r" forbids them.
+        Reading an edge in the direction opposite to the one that was set writes its inverse, so "r" only suits graphs whose inverses are resolved
+
+        Returns:
+        TransformationGraph: Graph, of the class it was saved from
+        """
+        with open(path, "rb") as f:
+            if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                raise Exception("Not a transformation graph file")
+            header_length = struct.unpack("<Q", f.read(8))[0]
+            header = pickle.loads(f.read(header_length))
+        data_start = _align(len(FILE_MAGIC) + 8 + header_length, PAGE_SIZE)
+        graph = header["graph"]
+        for name, (offset, shape, dtype) in header["arrays"].items():
+            if np.prod(shape) == 0:
+                setattr(graph, name, np.zeros(shape, dtype=dtype))
+            else:
+                setattr(graph, name, np.memmap(path, dtype=dtype, mode=mmap_mode, offset=data_start + offset, shape=shape))
+        return graph
+
+    @property
+    def topology(self) -> GraphTopology:
+        """Get the topology index of the graph, building it on first use
+
+        Returns:
+        GraphTopology: Topology index
+        """
+        if self._topology is None:
+            self._topology = GraphTopology(self)
+        return self._topology
 
     @property
     def num_nodes(self) -> int:
@@ -178,7 +629,7 @@ class TransformationGraph:
         Returns:
         int: Number of nodes
         """
-        return self._matrix.shape[0]
+        return self._num_nodes
 
     @property
     def num_frames(self) -> int:
@@ -187,90 +638,185 @@ class TransformationGraph:
         Returns:
         int: Number of frames
         """
-        return self._matrix.shape[2]
+        return self._transforms.shape[1]
+
+    @property
+    def compact(self) -> bool:
+        """Get whether transforms are stored as compact poses
+
+        Returns:
+        bool: True in compact mode
+        """
+        return self._compact
+
+    @property
+    def first_frame(self) -> int:
+        """Get the index of the first frame in the graph
+
+        Returns:
+        int: First frame
+        """
+        return 0
+
+class StreamingTransformationGraph(TransformationGraph):
+    """
+    Transformation graph for live sessions. Frames are pushed one at a time with append_frame and only the last capacity frames
+    are kept, in a preallocated ring buffer. Frames keep their absolute index, so graph[node1, node2, frame] works as usual for
+    any retained frame, and solvers can be run on each new frame as it arrives.
+
+    Rigid-known edges are calibrated constants, so clients only need to send them once: a rigid-known edge that is not measured
+    in a frame carries its value forward from the previous frame. All other edges that are not measured are nan.
+    """
+
+    def __init__(self, num_nodes: int, edges: list[tuple[int, int, Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"], float]], capacity: int, compact: bool=False, dtype: np.dtype=np.float64):
+        """Initialize the transformation graph
+
+        Parameters:
+        num_nodes (int): Number of nodes in the graph
+        edges (list[tuple[int, int, Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"], float]]): List of edges, where each edge is a tuple of (node1, node2, type, noise)
+        capacity (int): Number of most recent frames to keep
+        compact (bool): Store each transform as a 7 float pose (quaternion and translation) instead of a 4x4 matrix
+        dtype (np.dtype): Type of the stored poses in compact mode
+        """
+        super().__init__(num_nodes, edges, capacity, compact, dtype)
+        # Total number of frames appended so far, which is also the index of the next frame
+        self._frame_count = 0
+        # Both slots of every rigid-known edge, carried forward from frame to frame
+        rigid_known = np.array([edge_type == "rigid-known" for edge_type in self._types], dtype=bool)
+        self._carried_slots = np.flatnonzero(np.repeat(rigid_known, 2))
+
+    def append_frame(self, measurements: dict[tuple[int, int], np.ndarray]) -> int:
+        """Append a new frame, overwriting the oldest frame if the buffer is full
+
+        Parameters:
+        measurements (dict[tuple[int, int], np.ndarray]): Dictionary of (node1, node2) to transformation matrix, for the edges measured in this frame
+
+        Returns:
+        int: Index of the new frame
+        """
+        frame = self._frame_count
+        # Clear the reused position so stale transforms from the evicted frame do not leak into the new one
+        self._transforms[:, frame % self.capacity] = np.nan
+        self._stale[:, frame % self.capacity] = False
+        if frame > 0:
+            previous = (frame - 1) % self.capacity
+            self._transforms[self._carried_slots, frame % self.capacity] = self._transforms[self._carried_slots, previous]
+            self._stale[self._carried_slots, frame % self.capacity] = self._stale[self._carried_slots, previous]
+        self._frame_count += 1
+        self._version += 1
+        self._edge_versions[:] = self._version
+        for (node1, node2), value in measurements.items():
+            self[node1, node2, frame] = value
+        return frame
+
+    def stream(self, measurements: Iterable[dict[tuple[int, int], np.ndarray]], solvers: list = ()) -> Iterator[int]:
+        """Append frames from an iterable of measurements, solving each frame as it arrives
+
+        Parameters:
+        measurements (Iterable[dict[tuple[int, int], np.ndarray]]): Iterable of per frame measurements, as taken by append_frame
+        solvers (list): Solvers to run on every new frame, in order
+
+        Returns:
+        Iterator[int]: Iterator of solved frame indices
+        """
+        for frame_measurements in measurements:
+            frame = self.append_frame(frame_measurements)
+            for solver in solvers:
+                solver.solve(frame, frame + 1)
+            yield frame
+
+    def _get_frame_index(self, frame: int | slice) -> int | np.ndarray:
+        """Map an absolute frame, or a slice of frames, to its position in the ring buffer
+
+        Slices map to an index array, so reading a slice returns a copy rather than a view.
+
+        Parameters:
+        frame (int | slice): Frame or slice of frames
+
+        Returns:
+        int | np.ndarray: Position or positions in the ring buffer
+        """
+        if isinstance(frame, slice):
+            start = self.first_frame if frame.start is None else frame.start
+            stop = self._frame_count if frame.stop is None else frame.stop
+            if start < self.first_frame or stop > self._frame_count:
+                raise Exception("Frame range is not retained in the buffer")
+            return np.arange(start, stop, frame.step or 1) % self.capacity
+        if frame < 0:
+            frame += self._frame_count
+        if frame < self.first_frame or frame >= self._frame_count:
+            raise Exception("Frame is not retained in the buffer")
+        return frame % self.capacity
+
+    @property
+    def capacity(self) -> int:
+        """Get the number of frames the buffer can hold
+
+        Returns:
+        int: Capacity
+        """
+        return self._transforms.shape[1]
+
+    @property
+    def num_frames(self) -> int:
+        """Get the number of frames currently retained
+
+        Returns:
+        int: Number of frames
+        """
+        return min(self._frame_count, self.capacity)
+
+    @property
+    def first_frame(self) -> int:
+        """Get the index of the oldest retained frame
+
+        Returns:
+        int: First frame
+        """
+        return self._frame_count - self.num_frames
 
 class TestTransformationGraph(TransformationGraph):
     """
     Specialized transformation graph for testing. Generates random ground truth transformations for each node and frame.
     """
+    _frame_arrays = TransformationGraph._frame_arrays + ("_worldTransforms",)
 
-    def __init__(self, num_nodes: int, edges: list[tuple[int, int, Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"], float]], frames: int):
+    def __init__(self, num_nodes: int, edges: list[tuple[int, int, Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"], float]], frames: int, seed: int=None, compact: bool=False, dtype: np.dtype=np.float64):
         """Initialize the transformation graph
 
         Parameters:
         num_nodes (int): Number of nodes in the graph
         edges (list[tuple[int, int, Literal["rigid-unknown", "rigid-known", "non-rigid-unknown", "non-rigid-known"], float]]): List of edges, where each edge is a tuple of (node1, node2, type, noise)
         frames (int): Number of frames in the graph
+        seed (int): Seed for the ground truth generation, or None for a random seed
+        compact (bool): Store each transform as a 7 float pose (quaternion and translation) instead of a 4x4 matrix
+        dtype (np.dtype): Type of the stored poses in compact mode
         """
-        super().__init__(num_nodes, edges, frames)
-        # Identify node groups that are rigidly connected
-        nodes = set(range(num_nodes))
-        self._groups = []
-        self._groupMap = dict()
-        # For each node, use BFS to find all nodes that are rigidly connected. After that, remove all those nodes from the set. Repeat until all nodes are removed.
-        while len(nodes) > 0:
-            # Get a random node
-            node = nodes.pop()
-
-            # Add the node to the group
-            group = set([node])
-
-            # Add all rigidly connected nodes to the group
-            queue = [node]
-            while len(queue) > 0:
-                # Get the next node
-                node = queue.pop(0)
-
-                # Add all rigidly connected nodes to the group
-                for i in range(num_nodes):
-                    if self._types[node, i] == "rigid-known" or self._types[node, i] == "rigid-unknown":
-                        if i not in group:
-                            group.add(i)
-                            queue.append(i)
-
-            # Remove all nodes in the group from the set
-            nodes = nodes - group
-            self._groups.append(group)
-            for node in group:
-                self._groupMap[node] = len(self._groups) - 1
-
-        # Generate ground truth transformations        
-        self._worldTransforms = np.zeros((num_nodes, frames, 4, 4))
+        super().__init__(num_nodes, edges, frames, compact, dtype)
+        # Identify node groups that are rigidly connected, individual nodes are groups of size 1
+        self._groups = self.topology.groups
+        self._groupMap = {node: self.topology.get_group_id(node) for node in range(num_nodes)}
+
+        # Generate ground truth transformations
+        rng = np.random.default_rng(seed)
         # Generate random transformations within groups, which stays the same for all frames
         # Since we assume a node can only be in one group, we can generate a random transform for every node
         # Individual nodes can be considered as a group of size 1
-        intra_group_transforms = []
-        for node in range(num_nodes):
-            intra_group_transforms.append(generate_random_transform())
-        # Generate random group transforms per frame
-        group_transforms = []
-        for i in range(frames):
-            group_transforms.append([]) # Add a new frame
-            for group in self.groups:
-                group_transforms[i].append(generate_random_transform())
-        # Now we can generate per node transforms for each frame
-        for frame in range(frames):
-            for node in range(num_nodes):
-                group_id = self.get_group_id(node)
-                # Set the ground truth transform
-                self._worldTransforms[node, frame] = group_transforms[frame][group_id] @ intra_group_transforms[node]
-                # print(f'Ground truth transform for node {node} in frame {frame}:')
-                # print(self._worldTransforms[node, frame])
+        intra_group_transforms = generate_random_transforms(num_nodes, rng)
+        # Generate random group transforms per frame, as a (groups, frames, 4, 4) array
+        group_transforms = generate_random_transforms(len(self._groups) * frames, rng).reshape(len(self._groups), frames, 4, 4)
+        # Now we can generate per node transforms for all frames at once
+        group_ids = np.array([self.get_group_id(node) for node in range(num_nodes)], dtype=int)
+        self._worldTransforms = group_transforms[group_ids] @ intra_group_transforms[:, None]
         # Second pass to generate relative transforms
-        for frame in range(frames):
-            for node in range(num_nodes):
-                # For each edge, derive the relative transform from the ground truth
-                for (neighbor, edge_type, noise) in self.get_edges(node):
-                    # print(f'Calculating relative transform for edge ({node}, {neighbor}) in frame {frame}')
-                    # Skip if edge is not known
-                    if edge_type == "rigid-unknown" or edge_type == "non-rigid-unknown":
-                        continue
-                    # Get the relative transform using calc_relative_transform(from, to)
-                    # print(node, neighbor, frame)
-                    # print(self._worldTransforms[node, frame], self._worldTransforms[neighbor, frame])
-                    relative_transform = calc_relative_transform(self._worldTransforms[node, frame], self._worldTransforms[neighbor, frame])
-                    # print(relative_transform)
-                    self[node, neighbor, frame] = relative_transform
+        # For each edge, derive the relative transform from the ground truth, for all frames at once
+        for (node, neighbor, edge_type, noise) in self.get_all_edges():
+            # Skip if edge is not known
+            if edge_type == "rigid-unknown" or edge_type == "non-rigid-unknown":
+                continue
+            # Get the relative transform using calc_relative_transform(from, to)
+            relative_transform = calc_relative_transform(self._worldTransforms[node], self._worldTransforms[neighbor])
+            self.set_edge_frames((node, neighbor), relative_transform)
         # Now we should be done!
         # Note, mentally we can think of the world origin as a separate node with an unknown non-rigid transformation to every other node
 
@@ -296,6 +842,15 @@ class TestTransformationGraph(TransformationGraph):
         """
         return self._groups[group_id]
 
+    @property
+    def world_transforms(self) -> np.ndarray:
+        """Gets the ground truth world transforms
+
+        Returns:
+        np.ndarray: Array of (nodes, frames, 4, 4) world transforms
+        """
+        return self._worldTransforms
+
     @property
     def groups(self) -> list[set[int]]:
         """Gets a copy of the list of groups
@@ -311,15 +866,9 @@ class TestTransformationGraph(TransformationGraph):
         Returns:
         dict[int, dict[int, np.ndarray]]: Dictionary of world transforms
         """
-        world_transforms = dict()
-        for node in range(self.num_nodes):
-            world_transforms[node] = dict()
-            for frame in range(self.num_frames):
-                # Remember to convert nan to None
-                world_transforms[node][frame] = self._worldTransforms[node, frame].tolist()
-                world_transforms[node][frame] = [[None if math.isnan(x) else x for x in row] for row in world_transforms[node][frame]]
-                
-        return world_transforms
+        frames = range(self.first_frame, self.first_frame + self.num_frames)
+        world_transforms = _to_json_compatible(self._worldTransforms)
+        return {node: dict(zip(frames, world_transforms[node])) for node in range(self.num_nodes)}
         # Local transform matrix and world transforms could be merged into a single matrix if we treat the world origin as a node
 
     def local_transforms_to_dict(self) -> dict[int, dict[int, dict[int, np.ndarray]]]:
@@ -328,18 +877,12 @@ class TestTransformationGraph(TransformationGraph):
         Returns:
         dict[int, dict[int, dict[int, np.ndarray]]]: Dictionary of local transforms
         """
-        local_transforms = dict()
+        frames = range(self.first_frame, self.first_frame + self.num_frames)
+        local_transforms = {node: {neighbor: dict() for neighbor in range(self.num_nodes)} for node in range(self.num_nodes)}
+        # Only actual edges are visited, everything else stays an empty dictionary
         for node in range(self.num_nodes):
-            local_transforms[node] = dict()
-            for neighbor in range(self.num_nodes):
-                local_transforms[node][neighbor] = dict()
-                for frame in range(self.num_frames):
-                    try:
-                        local_transforms[node][neighbor][frame] = self[node, neighbor, frame].tolist()
-                        local_transforms[node][neighbor][frame] = [[None if math.isnan(x) else x for x in row] for row in local_transforms[node][neighbor][frame]]
-                    except Exception:
-                        # No connection
-                        pass
+            for neighbor in self._adjacency[node]:
+                local_transforms[node][neighbor] = dict(zip(frames, _to_json_compatible(self[node, neighbor, :])))
         return local_transforms
 
     # Local transform also serializes unknown transforms since they are meant to be solved
@@ -351,19 +894,23 @@ class TestTransformationGraph(TransformationGraph):
         Returns:
         dict[int, dict[int, dict[str, str]]]: Dictionary of edges
         """
-        edges = dict()
-        for node in range(self.num_nodes):
-            edges[node] = dict()
-            for neighbor in range(self.num_nodes):
-                edges[node][neighbor] = dict()
-                edges[node][neighbor]["type"] = self._types[node, neighbor]
-                edges[node][neighbor]["noise"] = self._noise[node, neighbor]
-                if np.isnan(edges[node][neighbor]["noise"]):
-                    edges[node][neighbor]["noise"] = None
+        edges = {node: {neighbor: {"type": None, "noise": None} for neighbor in range(self.num_nodes)} for node in range(self.num_nodes)}
+        for (node1, node2, edge_type, noise) in self.get_all_edges():
+            edge = {"type": edge_type, "noise": None if np.isnan(noise) else float(noise)}
+            edges[node1][node2] = edge
+            edges[node2][node1] = dict(edge)
         return edges
 
     def to_dict(self) -> dict[str, dict]:
-        """Converts the graph to a json compatible dictionary
+        """Converts the graph to a json compatible dictionary. The result is cached until the graph changes, so it must not be modified.
+
+        Returns:
+        dict[str, dict]: Dictionary of graph
+        """
+        return self._get_cached("dict", self._build_dict)
+
+    def _build_dict(self) -> dict[str, dict]:
+        """Builds the json compatible dictionary of the graph
 
         Returns:
         dict[str, dict]: Dictionary of graph
@@ -375,11 +922,37 @@ class TestTransformationGraph(TransformationGraph):
         return graph
 
     def to_json_string(self) -> str:
-        """Converts the graph to a json string
+        """Converts the graph to a json string. The result is cached until the graph changes.
 
         Returns:
         str: Json string
         """
-        return json.dumps(self.to_dict())
+        return self._get_cached("json", lambda: json.dumps(self.to_dict()))
+
+    def _get_cached(self, name: str, build) -> object:
+        """Gets a cached serialization of the graph, rebuilding it if the graph changed since it was cached
+
+        Parameters:
+        name (str): Name of the serialization
+        build (Callable[[], object]): Function building the serialization
 
-# TODO: Reimplement TransformationGraphs using iterators so that we can use the same solvers for real time and offline
\ No newline at end of file
+        Returns:
+        object: Serialization
+        """
+        cached = self._serialization_cache.get(name)
+        if cached is None or cached[0] != self._version:
+            with self.instrumentation.stage("serialize"):
+                cached = (self._version, build())
+            self._serialization_cache[name] = cached
+        return cached[1]
+
+def _to_json_compatible(array: np.ndarray) -> list:
+    """Converts an array to nested lists, with nan replaced by None for the whole array at once
+
+    Parameters:
+    array (np.ndarray): Array
+
+    Returns:
+    list: Nested lists
+    """
+    return np.where(np.isnan(array), None, array).tolist()
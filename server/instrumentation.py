@@ -0,0 +1,202 @@
+# Lightweight instrumentation of the hot paths of the graph, the solvers and the server
+# Stages (ingest, inverse, path search, solve, serialize, emit) are timed and counted, and latencies are recorded in
+# histograms with fixed logarithmic buckets. Everything is disabled by default: graphs and solvers hold NULL_INSTRUMENTATION,
+# whose methods do nothing, so the hot paths only pay for a method call.
+
+import bisect
+import cProfile
+import io
+import pstats
+import time
+from contextlib import contextmanager, nullcontext
+
+# Upper bounds of the histogram buckets in seconds, doubling from 1 microsecond to about 17 seconds, plus an overflow bucket
+HISTOGRAM_BOUNDS = tuple(1e-6 * 2 ** i for i in range(25))
+
+class Histogram(object):
+    """Histogram of durations with fixed logarithmic buckets, so recording is O(log buckets) and memory is constant.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        """Record a duration
+
+        Parameters:
+        seconds (float): Duration
+        """
+        self.counts[bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent: float) -> float:
+        """Get an upper bound of a percentile, the bound of the bucket it falls in
+
+        Parameters:
+        percent (float): Percentile between 0 and 100
+
+        Returns:
+        float: Upper bound of the percentile in seconds, or None if nothing was recorded
+        """
+        if self.count == 0:
+            return None
+        target = percent / 100 * self.count
+        cumulative = 0
+        for bound, count in zip(HISTOGRAM_BOUNDS, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        """Summarize the histogram as a JSON compatible dictionary
+
+        Returns:
+        dict: Dictionary of count, mean, max, approximate percentiles and the non empty buckets as [upper bound, count], with an upper bound of None for the overflow bucket
+        """
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count > 0 else None,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "buckets": [[bound, count] for bound, count in zip(HISTOGRAM_BOUNDS + (None,), self.counts) if count > 0],
+        }
+
+class Instrumentation(object):
+    """Collects per-stage timers and counters, latency histograms, and optionally a cProfile of every solve.
+    """
+
+    enabled = True
+
+    def __init__(self, profile: bool=False):
+        """Initialize the instrumentation
+
+        Parameters:
+        profile (bool): Whether to run solves under cProfile, which slows them down considerably
+        """
+        self.profiler = cProfile.Profile() if profile else None
+        self.reset()
+
+    def reset(self):
+        """Clear all timers, counters and histograms, but keep the profile
+        """
+        self._stages = dict()
+        self._counters = dict()
+        self._histograms = dict()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a stage, as in `with instrumentation.stage("solve"):`
+
+        Parameters:
+        name (str): Stage name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = [0, 0.0, 0.0]
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] = max(stage[2], seconds)
+
+    def count(self, name: str, amount: int=1):
+        """Increment a counter
+
+        Parameters:
+        name (str): Counter name
+        amount (int): Amount to add
+        """
+        self._counters[name] = self._counters.get(name, 0) + amount
+
+    def record_latency(self, name: str, seconds: float):
+        """Record a latency in a histogram
+
+        Parameters:
+        name (str): Histogram name
+        seconds (float): Latency
+        """
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram()
+        histogram.record(seconds)
+
+    def profile(self):
+        """Context manager that runs its body under cProfile if profiling is enabled
+
+        Returns:
+        ContextManager: Context manager
+        """
+        return self.profiler if self.profiler is not None else nullcontext()
+
+    def profile_stats(self, sort: str="cumulative", limit: int=30) -> str:
+        """Format the profile collected so far
+
+        Parameters:
+        sort (str): Sort key, as taken by pstats.Stats.sort_stats
+        limit (int): Number of functions to list
+
+        Returns:
+        str: Profile report, or None if profiling is disabled or nothing has been profiled yet
+        """
+        # pstats cannot be built from a profiler that has not recorded anything
+        if self.profiler is None or len(self.profiler.getstats()) == 0:
+            return None
+        output = io.StringIO()
+        pstats.Stats(self.profiler, stream=output).sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def stats(self) -> dict:
+        """Get all statistics as a JSON compatible dictionary
+
+        Returns:
+        dict: Dictionary of stages (count, total, mean and max seconds), counters and latency histograms
+        """
+        return {
+            "stages": {
+                name: {"count": count, "total": total, "mean": total / count, "max": maximum}
+                for name, (count, total, maximum) in self._stages.items()
+            },
+            "counters": dict(self._counters),
+            "latency": {name: histogram.to_dict() for name, histogram in self._histograms.items()},
+        }
+
+class NullInstrumentation(object):
+    """Instrumentation that records nothing, used when instrumentation is disabled.
+    """
+
+    enabled = False
+    _context = nullcontext()
+
+    def stage(self, name: str):
+        return self._context
+
+    def count(self, name: str, amount: int=1):
+        pass
+
+    def record_latency(self, name: str, seconds: float):
+        pass
+
+    def profile(self):
+        return self._context
+
+    def profile_stats(self, sort: str="cumulative", limit: int=30) -> str:
+        return None
+
+    def stats(self) -> dict:
+        return {"stages": dict(), "counters": dict(), "latency": dict()}
+
+    def reset(self):
+        pass
+
+NULL_INSTRUMENTATION = NullInstrumentation()
@@ -0,0 +1,122 @@
+# Parallel solving of recorded sessions over chunks of frames
+# The frame arrays that solvers write are copied once into shared memory, worker processes attach to them instead of receiving
+# pickled copies, and every worker writes its solved frames straight back into the shared arrays. Graphs loaded with
+# TransformationGraph.load in "r+" mode are not copied at all: workers map the same file and write to it directly.
+
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from graphs import TransformationGraph
+from solver import BaseSolver, LoopClosureSolver
+
+# Frame arrays that solvers write, the other frame arrays of a graph (such as the ground truth of test graphs) are never
+# sent to the workers
+SOLVED_ARRAYS = ("_transforms", "_stale")
+
+# State of a worker process, set once by _init_worker
+_worker_solver = None
+_worker_memory = []
+
+def _attach_arrays(graph: TransformationGraph, specs: dict[str, tuple[str, str, int, tuple[int, ...], str]]) -> list[shared_memory.SharedMemory]:
+    """Set the frame arrays of a detached graph to arrays backed by shared memory or by the memory mapped file of the graph
+
+    Parameters:
+    graph (TransformationGraph): Detached graph
+    specs (dict[str, tuple[str, str, int, tuple[int, ...], str]]): Dictionary of array name to (kind, location, offset, shape, dtype),
+    where kind is "memory" with the name of a shared memory block as location, or "file" with the path of a file mapped in "r+" mode
+
+    Returns:
+    list[shared_memory.SharedMemory]: Attached shared memory blocks, which must be kept alive while the arrays are in use
+    """
+    memory = []
+    for name, (kind, location, offset, shape, dtype) in specs.items():
+        if kind == "file":
+            setattr(graph, name, np.memmap(location, dtype=dtype, mode="r+", offset=offset, shape=shape))
+            continue
+        block = shared_memory.SharedMemory(name=location)
+        memory.append(block)
+        setattr(graph, name, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+    return memory
+
+def _init_worker(graph: TransformationGraph, specs: dict[str, tuple[str, str, int, tuple[int, ...], str]], solver_class: type, solver_kwargs: dict):
+    """Initialize a worker process with the graph attached to shared memory and its own solver
+    """
+    global _worker_solver, _worker_memory
+    _worker_memory = _attach_arrays(graph, specs)
+    _worker_solver = solver_class(graph, **solver_kwargs)
+
+def _solve_chunk(chunk: tuple[int, int]):
+    """Solve a chunk of frames in a worker process
+
+    Parameters:
+    chunk (tuple[int, int]): Tuple of (start_frame, end_frame)
+    """
+    _worker_solver.solve(*chunk)
+
+class ParallelSolver(BaseSolver):
+    """Runs a solver over chunks of frames in a process pool.
+
+    Only solvers that treat frames independently, such as LoopClosureSolver, can be split this way. Solvers that carry
+    state from frame to frame, such as HandEyeSolver, must be run sequentially, and so must LoopClosureSolver with a
+    forgetting factor, whose noise estimates would be updated in the workers and lost.
+    """
+
+    def __init__(self, graph: TransformationGraph, solver_class: type=LoopClosureSolver, solver_kwargs: dict=None, processes: int=None, chunk_size: int=None):
+        """Initialize the solver with a graph.
+
+        Parameters:
+        graph (TransformationGraph): Graph to solve
+        solver_class (type): Solver to run on each chunk
+        solver_kwargs (dict): Keyword arguments for the solver, besides the graph
+        processes (int): Number of worker processes, or None for the number of CPUs
+        chunk_size (int): Number of frames per chunk, or None to split the range into four chunks per process
+        """
+        super().__init__(graph)
+        self.solver_class = solver_class
+        self.solver_kwargs = dict() if solver_kwargs is None else solver_kwargs
+        if self.solver_kwargs.get("forgetting") is not None:
+            raise Exception("Online noise estimation with a forgetting factor cannot be run in parallel")
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        self.chunk_size = chunk_size
+
+    def _solve(self, start_frame:int, end_frame:int):
+        """Solve the graph for the given frame range, with chunks of frames solved in parallel.
+
+        Parameters:
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+        """
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            chunk_size = -(-(end_frame - start_frame) // (4 * self.processes))
+        chunks = [(start, min(start + chunk_size, end_frame)) for start in range(start_frame, end_frame, chunk_size)]
+
+        # Share the solved arrays with the workers, through the file of the graph if it is mapped for writing, otherwise by
+        # copying them into shared memory once
+        memory = dict()
+        specs = dict()
+        try:
+            for name in SOLVED_ARRAYS:
+                array = getattr(self.graph, name)
+                if isinstance(array, np.memmap) and array.mode == "r+" and array.filename is not None:
+                    array.flush()
+                    specs[name] = ("file", array.filename, array.offset, array.shape, array.dtype.str)
+                    continue
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                memory[name] = block
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                specs[name] = ("memory", block.name, 0, array.shape, array.dtype.str)
+
+            with multiprocessing.Pool(self.processes, _init_worker, (self.graph._detach_frame_arrays(), specs, self.solver_class, self.solver_kwargs)) as pool:
+                pool.map(_solve_chunk, chunks)
+
+            # Stitch the solved frames back into the graph, the workers wrote file backed arrays in place
+            for name, block in memory.items():
+                array = getattr(self.graph, name)
+                array[...] = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            self.graph._version += 1
+            self.graph._edge_versions[:] = self.graph._version
+        finally:
+            for block in memory.values():
+                block.close()
+                block.unlink()
@@ -0,0 +1,132 @@
+# Compact binary wire format for streaming graphs to viewers
+# The edge table (nodes, edge endpoints, types and noise) is sent once as JSON when a client connects
+# After that, each frame is sent as a binary message holding only the poses that changed since the last message
+
+# === Frame message layout (little endian) ===
+# uint8   channel      EDGE_CHANNEL for edge transforms (node1 -> node2), NODE_CHANNEL for world transforms of nodes
+# uint32  frame        Frame index
+# uint32  count        Number of records
+# count records of:
+#   uint32      index  Edge id (position in the edge table) or node id
+#   float32[7]  pose   Quaternion (w, x, y, z) followed by translation (x, y, z), all nan if unsolved
+
+import numpy as np
+from graphs import TransformationGraph
+from tools import matrices_to_poses
+
+EDGE_CHANNEL = 0
+NODE_CHANNEL = 1
+
+HEADER_DTYPE = np.dtype([("channel", "<u1"), ("frame", "<u4"), ("count", "<u4")])
+RECORD_DTYPE = np.dtype([("index", "<u4"), ("pose", "<f4", (7,))])
+
+def encode_edge_table(graph: TransformationGraph) -> dict:
+    """Encode the static part of the graph as a JSON compatible dictionary, sent once per client
+
+    Parameters:
+    graph (TransformationGraph): Graph to encode
+
+    Returns:
+    dict: Dictionary with the number of nodes and the list of edges, in edge id order
+    """
+    return {
+        "num_nodes": graph.num_nodes,
+        "edges": [
+            {"from": node1, "to": node2, "type": edge_type, "noise": None if np.isnan(noise) else float(noise)}
+            for (node1, node2, edge_type, noise) in graph.get_all_edges()
+        ],
+    }
+
+def transforms_to_poses(transforms: np.ndarray) -> np.ndarray:
+    """Convert a stack of rigid transforms to float32 quaternion + translation poses
+
+    Parameters:
+    transforms (np.ndarray): Stack of (..., 4, 4) transforms
+
+    Returns:
+    np.ndarray: Stack of (..., 7) poses, all nan where the transform is unsolved
+    """
+    poses = matrices_to_poses(transforms, np.float32)
+    poses[np.isnan(poses).any(axis=-1)] = np.nan
+    return poses
+
+def encode_poses(channel: int, frame: int, indices: np.ndarray, poses: np.ndarray) -> bytes:
+    """Pack poses into a frame message
+
+    Parameters:
+    channel (int): EDGE_CHANNEL or NODE_CHANNEL
+    frame (int): Frame index
+    indices (np.ndarray): Edge or node ids of the poses
+    poses (np.ndarray): Stack of (count, 7) poses
+
+    Returns:
+    bytes: Frame message
+    """
+    header = np.array([(channel, frame, len(indices))], dtype=HEADER_DTYPE)
+    records = np.empty(len(indices), dtype=RECORD_DTYPE)
+    records["index"] = indices
+    records["pose"] = poses
+    return header.tobytes() + records.tobytes()
+
+def decode_poses(message: bytes) -> tuple[int, int, np.ndarray, np.ndarray]:
+    """Unpack a frame message
+
+    Parameters:
+    message (bytes): Frame message
+
+    Returns:
+    tuple[int, int, np.ndarray, np.ndarray]: Tuple of (channel, frame, indices, poses)
+    """
+    header = np.frombuffer(message, dtype=HEADER_DTYPE, count=1)[0]
+    records = np.frombuffer(message, dtype=RECORD_DTYPE, offset=HEADER_DTYPE.itemsize, count=int(header["count"]))
+    return int(header["channel"]), int(header["frame"]), records["index"].astype(int), records["pose"]
+
+class PoseDeltaEncoder(object):
+    """Encodes a fixed set of poses frame after frame, sending only the poses that changed since the last message.
+
+    The encoder keeps the last state it sent, so one encoder is shared by all clients of a broadcast. A newly connected
+    client is first sent keyframe(), which is exactly that state, so that later deltas apply on top of it.
+    """
+
+    def __init__(self, channel: int, count: int, tolerance: float=1e-6):
+        """Initialize the encoder
+
+        Parameters:
+        channel (int): EDGE_CHANNEL or NODE_CHANNEL
+        count (int): Number of poses, which is the number of edges or nodes
+        tolerance (float): Largest change of any pose component that is not sent
+        """
+        self.channel = channel
+        self.tolerance = tolerance
+        self._poses = np.full((count, 7), np.nan, dtype=np.float32)
+        self._frame = 0
+
+    def encode(self, frame: int, transforms: np.ndarray) -> bytes:
+        """Encode the poses of a frame that changed since the last message
+
+        Parameters:
+        frame (int): Frame index
+        transforms (np.ndarray): Stack of (count, 4, 4) transforms
+
+        Returns:
+        bytes: Frame message, or None if nothing changed
+        """
+        poses = transforms_to_poses(transforms)
+        solved = ~np.isnan(poses[:, 0])
+        was_solved = ~np.isnan(self._poses[:, 0])
+        with np.errstate(invalid="ignore"):
+            moved = (np.abs(poses - self._poses) > self.tolerance).any(axis=-1)
+        changed = np.flatnonzero((solved != was_solved) | (solved & moved))
+        self._frame = frame
+        if len(changed) == 0:
+            return None
+        self._poses[changed] = poses[changed]
+        return encode_poses(self.channel, frame, changed, poses[changed])
+
+    def keyframe(self) -> bytes:
+        """Encode every pose of the last sent state, for clients that have not received anything yet
+
+        Returns:
+        bytes: Frame message
+        """
+        return encode_poses(self.channel, self._frame, np.arange(len(self._poses)), self._poses)
@@ -0,0 +1,136 @@
+# Resolution of the pose of every node relative to a root node
+# A spanning tree rooted at the root node is built once, then the poses of all nodes for a block of frames are
+# resolved level by level with batched matrix products. Resolved blocks are memoized, and when edges change only the subtrees
+# below the changed tree edges are resolved again.
+
+import heapq
+import numpy as np
+from graphs import TransformationGraph
+from solver import UNKNOWN_TYPES
+
+class WorldPoseResolver(object):
+    """Resolves the transforms from a root node to every node of a graph, for blocks of frames.
+
+    Nodes that are not connected to the root, and frames where an edge on the tree path from the root is unsolved, are nan.
+    """
+
+    def __init__(self, graph: TransformationGraph, root: int=0, max_blocks: int=8):
+        """Initialize the resolver
+
+        Parameters:
+        graph (TransformationGraph): Graph to resolve
+        root (int): Node that defines the common frame
+        max_blocks (int): Number of resolved frame blocks to memoize, the least recently used block is evicted first
+        """
+        self.graph = graph
+        self.root = root
+        self.max_blocks = max_blocks
+        self._levels = None
+        # Dictionary of (start_frame, end_frame) to (edge versions when resolved, (num_nodes, frames, 4, 4) transforms)
+        self._blocks = dict()
+
+    def _build_tree(self):
+        """Build the spanning tree with a shortest path search from the root, so every node is reached over the fewest unknown
+        edges, which may be unsolved, and then over the fewest edges
+        """
+        topology = self.graph.topology
+        num_nodes = self.graph.num_nodes
+        self._parents = np.full(num_nodes, -1)
+        self._parent_edges = np.full(num_nodes, -1)
+        children = [[] for _ in range(num_nodes)]
+        costs = {self.root: (0, 0)}
+        depths = {self.root: 0}
+        reached = set()
+        queue = [(0, 0, self.root)]
+        while len(queue) > 0:
+            unknown, length, node = heapq.heappop(queue)
+            if node in reached:
+                continue
+            reached.add(node)
+            if node != self.root:
+                parent = self._parents[node]
+                children[parent].append(node)
+                depths[node] = depths[parent] + 1
+            for (neighbor, edge_type) in topology.get_neighbors(node):
+                cost = (unknown + (edge_type in UNKNOWN_TYPES), length + 1)
+                if neighbor in reached or cost >= costs.get(neighbor, (num_nodes, num_nodes)):
+                    continue
+                costs[neighbor] = cost
+                self._parents[neighbor] = node
+                self._parent_edges[neighbor] = self.graph._get_slot(node, neighbor) >> 1
+                heapq.heappush(queue, cost + (neighbor,))
+
+        # Group the nodes by depth, so the parents of every level are resolved by the previous levels
+        levels = [[] for _ in range(max(depths.values()) + 1)]
+        for node, depth in depths.items():
+            levels[depth].append(node)
+        self._levels = [np.array(level) for level in levels]
+
+        # List the tree in depth first order, so the subtree of a node is the range [_enter[node], _exit[node]) of _preorder
+        preorder = []
+        self._enter = np.full(num_nodes, -1)
+        self._exit = np.full(num_nodes, -1)
+        stack = [(self.root, False)]
+        while len(stack) > 0:
+            node, done = stack.pop()
+            if done:
+                self._exit[node] = len(preorder)
+                continue
+            self._enter[node] = len(preorder)
+            preorder.append(node)
+            stack.append((node, True))
+            stack.extend((child, False) for child in children[node])
+        self._preorder = np.array(preorder)
+
+    def resolve(self, start_frame: int=None, end_frame: int=-1) -> np.ndarray:
+        """Resolve the transforms from the root to every node for a block of frames
+
+        Parameters:
+        start_frame (int): First frame, or None for the first frame of the graph
+        end_frame (int): Frame after the last frame, or -1 for the end of the graph
+
+        Returns:
+        np.ndarray: Array of (num_nodes, frames, 4, 4) transforms, which must not be modified
+        """
+        start_frame, end_frame = self.graph.get_frame_range(start_frame, end_frame)
+        if self._levels is None:
+            self._build_tree()
+
+        key = (start_frame, end_frame)
+        versions = self.graph._edge_versions
+        block = self._blocks.pop(key, None)
+        if block is None:
+            transforms = np.full((self.graph.num_nodes, end_frame - start_frame, 4, 4), np.nan)
+            transforms[self.root] = np.eye(4)
+            self._resolve_nodes(transforms, start_frame, end_frame, None)
+        else:
+            resolved_versions, transforms = block
+            changed = self._parent_edges >= 0
+            changed[changed] = versions[self._parent_edges[changed]] != resolved_versions[self._parent_edges[changed]]
+            if np.any(changed):
+                # A node must be resolved again if it is in the subtree of a node whose tree edge changed
+                stale = np.zeros(self.graph.num_nodes, dtype=bool)
+                for node in np.flatnonzero(changed):
+                    stale[self._preorder[self._enter[node]:self._exit[node]]] = True
+                self._resolve_nodes(transforms, start_frame, end_frame, stale)
+        self._blocks[key] = (versions.copy(), transforms)
+        if len(self._blocks) > self.max_blocks:
+            del self._blocks[next(iter(self._blocks))]
+        return transforms
+
+    def _resolve_nodes(self, transforms: np.ndarray, start_frame: int, end_frame: int, stale: np.ndarray):
+        """Resolve nodes level by level, with one batched matrix product per level
+
+        Parameters:
+        transforms (np.ndarray): Array of (num_nodes, frames, 4, 4) transforms to update in place
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+        stale (np.ndarray): Boolean mask of the nodes to resolve, or None for all nodes
+        """
+        for level in self._levels[1:]:
+            if stale is not None:
+                level = level[stale[level]]
+                if len(level) == 0:
+                    continue
+            edges = np.stack([self.graph[self._parents[node], node, start_frame:end_frame] for node in level])
+            transforms[level] = np.matmul(transforms[self._parents[level]], edges)
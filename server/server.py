@@ -1,8 +1,18 @@
 # Websocket server for manipulating the scene
+import argparse
+import json
+import time
+import numpy as np
 import socketio
 import eventlet
+from eventlet.green import socket
 
-from graphs import TestTransformationGraph # Needed for socketio
+from graphs import TestTransformationGraph, StreamingTransformationGraph # Needed for socketio
+from protocol import EDGE_CHANNEL, NODE_CHANNEL, PoseDeltaEncoder, encode_edge_table
+from instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from solver import LoopClosureSolver, HandEyeSolver
+from resolver import WorldPoseResolver
+from filters import KalmanFilterSolver
 
 sio = socketio.Server(cors_allowed_origins='*')
 app = socketio.WSGIApp(sio)
@@ -11,18 +21,194 @@ CAMERA = 0
 HEADSET = 1
 WORLD = 2
 
-# Create the world
-world = TestTransformationGraph(3, [
+EDGES = [
     (CAMERA, HEADSET, "non-rigid-unknown", 1),
     (CAMERA, WORLD, "rigid-known", 1),
     (HEADSET, WORLD, "rigid-known", 1),
-], 1)
+]
+
+# The world, set with set_world when the server starts: a streaming graph in live mode, otherwise a random test graph.
+# It is not built at import time, since test graphs load SciPy to generate their random transforms
+world = None
+
+# Clients either receive the whole graph as JSON ("graph" event), or the edge table once ("edges" event) followed by binary
+# per frame deltas ("frame" events, see protocol.py)
+use_json = False
+
+# Delta encoders shared by all clients, they hold the last state that was broadcast
+edge_encoder = None
+node_encoder = None
+
+# Resolves the node poses of graphs without ground truth world transforms, relative to node 0
+resolver = None
+
+# Filter of the solved non-rigid edges in live mode, and the number of frames its edges are predicted ahead when broadcast
+edge_filter = None
+predict_ahead = 0
+
+# Frames of measurements received in live mode but not solved yet, as (time received, measurements)
+pending_frames = []
+dropped_frames = 0
+
+# Timers and counters of the hot paths, sent to clients through the stats event, disabled unless --stats or --profile is given
+instrumentation = NULL_INSTRUMENTATION
+
+def set_world(graph):
+    """Replace the world and reset the broadcast state
+
+    Parameters:
+    graph (TransformationGraph): New world
+    """
+    global world, edge_encoder, node_encoder, resolver
+    world = graph
+    world.instrumentation = instrumentation
+    edge_encoder = PoseDeltaEncoder(EDGE_CHANNEL, len(world.get_all_edges()))
+    node_encoder = PoseDeltaEncoder(NODE_CHANNEL, world.num_nodes)
+    # Test graphs have ground truth world transforms for every node, other graphs are resolved from their edges
+    resolver = None if isinstance(world, TestTransformationGraph) else WorldPoseResolver(world)
+
+def publish_frame(frame: int):
+    """Broadcast the edges and nodes that changed in a frame to all clients
+
+    Parameters:
+    frame (int): Frame
+    """
+    with instrumentation.stage("serialize"):
+        nodes = world.world_transforms[:, frame] if resolver is None else resolver.resolve(frame, frame + 1)[:, 0]
+        edges = world.get_edge_transforms(frame)
+        if edge_filter is not None and predict_ahead > 0:
+            edges = edges.copy()
+            edges[edge_filter.edge_ids] = edge_filter.predict(predict_ahead)
+        messages = [edge_encoder.encode(frame, edges), node_encoder.encode(frame, nodes)]
+    with instrumentation.stage("emit"):
+        for message in messages:
+            if message is not None:
+                sio.emit('frame', message)
+                instrumentation.count("bytes_emitted", len(message))
+
+def parse_measurements(data: list[dict]) -> dict[tuple[int, int], np.ndarray]:
+    """Parse a frame of measurements, given as a list of {"from": node1, "to": node2, "transform": 4x4 nested list}.
+    Measurements of edges that are not in the world, or that are not finite 4x4 matrices, are dropped with a message, so
+    that a bad client cannot break the live loop.
+
+    Parameters:
+    data (list[dict]): Measurements
+
+    Returns:
+    dict[tuple[int, int], np.ndarray]: Dictionary of (node1, node2) to transformation matrix, as taken by append_frame
+    """
+    measurements = dict()
+    for measurement in data:
+        try:
+            node1, node2 = int(measurement["from"]), int(measurement["to"])
+            transform = np.array(measurement["transform"], dtype=float)
+        except (ValueError, KeyError, TypeError, OverflowError) as e:
+            print(f'Invalid measurement: {e}')
+            continue
+        if not (0 <= node1 < world.num_nodes and 0 <= node2 < world.num_nodes) or world.get_type((node1, node2)) is None:
+            print(f'Dropped measurement of unknown edge ({node1}, {node2})')
+            continue
+        if transform.shape != (4, 4):
+            print(f'Dropped measurement of edge ({node1}, {node2}) with shape {transform.shape}')
+            continue
+        if not np.all(np.isfinite(transform)):
+            print(f'Dropped measurement of edge ({node1}, {node2}) with non finite values')
+            continue
+        measurements[(node1, node2)] = transform
+    return measurements
+
+def live_loop(solvers: list, rate: float):
+    """Solve incoming frames and broadcast the latest solved frame at most rate times per second.
+
+    Frames that arrive while a solve is running are coalesced into a single frame, keeping the latest measurement of each
+    edge, so a slow solve drops frames instead of falling further and further behind.
+
+    Parameters:
+    solvers (list): Solvers to run on every frame, in order
+    rate (float): Maximum number of broadcasts per second
+    """
+    global pending_frames, dropped_frames
+    period = 1 / rate
+    last_broadcast = 0
+    unpublished = None
+    while True:
+        if len(pending_frames) > 0:
+            frames, pending_frames = pending_frames, []
+            dropped_frames += len(frames) - 1
+            instrumentation.count("frames_dropped", len(frames) - 1)
+            try:
+                with instrumentation.stage("ingest"):
+                    measurements = dict()
+                    for (_, frame_measurements) in frames:
+                        measurements.update(frame_measurements)
+                    frame = world.append_frame(measurements)
+                for solver in solvers:
+                    solver.solve(frame, frame + 1)
+            except Exception as e:
+                # A frame that cannot be solved is skipped, the loop must keep running for the next frames
+                print(f'Failed to solve frame: {e!r}')
+                instrumentation.count("frames_failed")
+            else:
+                # Latency is measured from the oldest measurement of the frame
+                if unpublished is None:
+                    received = frames[0][0]
+                unpublished = frame
+        now = time.monotonic()
+        if unpublished is not None and now - last_broadcast >= period:
+            publish_frame(unpublished)
+            instrumentation.record_latency("frame", time.monotonic() - received)
+            unpublished = None
+            last_broadcast = now
+        # Yield to the socket handlers, and do not spin while idle
+        eventlet.sleep(0 if len(pending_frames) > 0 else 0.001)
+
+def udp_loop(port: int):
+    """Receive frames of measurements as JSON datagrams, in the same format as the measurements event
+
+    Parameters:
+    port (int): UDP port to listen on
+    """
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.bind(('', port))
+    while True:
+        data, _ = udp.recvfrom(65536)
+        try:
+            with instrumentation.stage("ingest"):
+                pending_frames.append((time.monotonic(), parse_measurements(json.loads(data))))
+        except (ValueError, KeyError, TypeError, OverflowError) as e:
+            print(f'Invalid measurements datagram: {e!r}')
 
 # On connection, send the scene to the client, use dummy data for now
 @sio.on('connect')
 def on_connect(sid, environ):
     print(f'Client connected: {sid}')
-    sio.emit('graph', world.to_dict())
+    if use_json:
+        # Send the cached JSON string, so the graph is encoded once for all clients instead of once per client
+        sio.emit('graph', world.to_json_string(), to=sid)
+        return
+    # Send the static edge table, then the last broadcast state so that later deltas apply on top of it
+    sio.emit('edges', encode_edge_table(world), to=sid)
+    sio.emit('frame', edge_encoder.keyframe(), to=sid)
+    sio.emit('frame', node_encoder.keyframe(), to=sid)
+
+# On measurements, queue them as a new frame for the live loop
+@sio.on('measurements')
+def on_measurements(sid, data):
+    if not isinstance(world, StreamingTransformationGraph):
+        return
+    try:
+        with instrumentation.stage("ingest"):
+            pending_frames.append((time.monotonic(), parse_measurements(data)))
+    except (ValueError, KeyError, TypeError, OverflowError) as e:
+        print(f'Invalid measurements: {e!r}')
+
+# On stats, send the timers, counters and latency histograms of the server to the client
+@sio.on('stats')
+def on_stats(sid, data=None):
+    stats = instrumentation.stats()
+    stats["dropped_frames"] = dropped_frames
+    stats["profile"] = instrumentation.profile_stats()
+    sio.emit('stats', stats, to=sid)
 
 # # On scene update, send the scene to all clients
 # @sio.on('update')
@@ -35,4 +221,47 @@ def on_disconnect(sid):
     print(f'Client disconnected: {sid}')
 
 if __name__ == '__main__':
-    eventlet.wsgi.server(eventlet.listen(('', 5000)), app)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Transformation graph server")
+    parser.add_argument("--json", action="store_true", help="Send the whole graph as JSON instead of binary deltas")
+    parser.add_argument("--live", action="store_true", help="Solve and broadcast measurements received through the measurements event")
+    parser.add_argument("--graph", help="JSON file with the live graph as {\"num_nodes\": int, \"edges\": [[node1, node2, type, noise], ...]}, defaults to the camera, headset and world graph")
+    parser.add_argument("--capacity", type=int, default=1000, help="Number of frames kept in live mode")
+    parser.add_argument("--rate", type=float, default=30, help="Maximum number of broadcasts per second in live mode")
+    parser.add_argument("--window", type=int, default=None, help="Number of motions used to solve rigid-unknown edges in live mode, defaults to all")
+    parser.add_argument("--udp", type=int, default=None, help="Also receive measurements as JSON datagrams on this UDP port in live mode")
+    parser.add_argument("--robust", action="store_true", help="Down-weight inconsistent loops when solving non-rigid-unknown edges in live mode")
+    parser.add_argument("--forgetting", type=float, default=None, help="Forgetting factor per frame of the online noise estimates of known edges in live mode, defaults to fixed noise")
+    parser.add_argument("--filter", action="store_true", help="Filter the solved non-rigid-unknown edges with a Kalman filter in live mode")
+    parser.add_argument("--process-noise", type=float, default=0.01, help="Standard deviation of the acceleration per frame of filtered edges")
+    parser.add_argument("--predict", type=float, default=0, help="Number of frames to predict filtered edges ahead when broadcasting, to hide the latency to viewers")
+    parser.add_argument("--stats", action="store_true", help="Record timers, counters and latency histograms, sent to clients on the stats event")
+    parser.add_argument("--profile", action="store_true", help="Also profile every solve with cProfile, implies --stats")
+    args = parser.parse_args()
+    if args.json and args.live:
+        parser.error("--json is not supported in live mode")
+    if args.predict > 0 and not args.filter:
+        parser.error("--predict requires --filter")
+    use_json = args.json
+    if args.stats or args.profile:
+        instrumentation = Instrumentation(profile=args.profile)
+    if args.live:
+        num_nodes, edges = 3, EDGES
+        if args.graph is not None:
+            with open(args.graph) as f:
+                graph = json.load(f)
+            num_nodes, edges = graph["num_nodes"], [tuple(edge) for edge in graph["edges"]]
+        set_world(StreamingTransformationGraph(num_nodes, edges, args.capacity))
+        solvers = [HandEyeSolver(world, args.window), LoopClosureSolver(world, robust=args.robust, forgetting=args.forgetting)]
+        if args.filter:
+            edge_filter = KalmanFilterSolver(world, args.process_noise)
+            predict_ahead = args.predict
+            solvers.append(edge_filter)
+        for solver in solvers:
+            solver.instrumentation = instrumentation
+        sio.start_background_task(live_loop, solvers, args.rate)
+        if args.udp is not None:
+            sio.start_background_task(udp_loop, args.udp)
+    else:
+        set_world(TestTransformationGraph(3, EDGES, 1))
+        publish_frame(0)
+    eventlet.wsgi.server(eventlet.listen(('', 5000)), app)
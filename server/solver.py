@@ -1,5 +1,12 @@
-from server.graphs import TransformationGraph
+import time
+import numpy as np
+from collections import deque
+from graphs import TransformationGraph
+from instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from tools import project_to_rotation, rotation_to_quaternion, quaternion_to_rotation, invert_rigid_transform, se3_exp, se3_log, compose_poses, poses_to_matrices
 
+KNOWN_TYPES = ("rigid-known", "non-rigid-known")
+UNKNOWN_TYPES = ("rigid-unknown", "non-rigid-unknown")
 
 class BaseSolver(object):
     """Base class for solvers that provides common functionality.
@@ -9,15 +16,872 @@ class BaseSolver(object):
         """Initialize the solver with a graph.
         """
         self.graph = graph
+        self.instrumentation = NULL_INSTRUMENTATION
 
-    # def solve(start_frame:int=0, end_frame:int=-1):
-    #     """Solve the graph for the given frame range.
-    #     """
-    #     raise NotImplementedError
+    def solve(self, start_frame:int=None, end_frame:int=-1):
+        """Solve the graph for the given frame range.
+
+        Parameters:
+        start_frame (int): First frame, or None for the first frame of the graph
+        end_frame (int): Frame after the last frame, or -1 for the end of the graph
+
+        Returns:
+        object: Whatever the solver returns, see _solve
+        """
+        start_frame, end_frame = self.graph.get_frame_range(start_frame, end_frame)
+        if not self.instrumentation.enabled:
+            return self._solve(start_frame, end_frame)
+        start = time.perf_counter()
+        with self.instrumentation.stage("solve"), self.instrumentation.profile():
+            result = self._solve(start_frame, end_frame)
+        self.instrumentation.record_latency("solve_per_frame", (time.perf_counter() - start) / (end_frame - start_frame))
+        self.instrumentation.count("frames_solved", end_frame - start_frame)
+        return result
+
+    def _solve(self, start_frame:int, end_frame:int):
+        """Solve the graph for a resolved frame range, implemented by subclasses.
+        """
+        raise NotImplementedError
+
+    def instrument(self, instrumentation:Instrumentation=None) -> Instrumentation:
+        """Enable instrumentation of this solver and of its graph, which share the same instrumentation.
+
+        Parameters:
+        instrumentation (Instrumentation): Instrumentation to record into, or None for a new one
+
+        Returns:
+        Instrumentation: Instrumentation in use
+        """
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation
+        self.graph.instrumentation = instrumentation
+        return instrumentation
+
+    def stats(self) -> dict:
+        """Get the statistics recorded by the instrumentation, see Instrumentation.stats
+
+        Returns:
+        dict: Statistics, empty if the solver is not instrumented
+        """
+        return self.instrumentation.stats()
+
+    def _find_paths(self, start:int, end:int, max_length:int=None, edge_types:tuple[str, ...]=KNOWN_TYPES) -> list[tuple[int, ...]]:
+        """Find all simple paths between two nodes, using the cached topology index of the graph.
+
+        Parameters:
+        start (int): Node to start from
+        end (int): Node to end at
+        max_length (int): Maximum number of edges in a path, or None for no limit
+        edge_types (tuple[str, ...]): Edge types that paths may use, known edges by default
+
+        Returns:
+        list[tuple[int, ...]]: List of paths, where each path is a tuple of nodes from start to end
+        """
+        with self.instrumentation.stage("path_search"):
+            return self.graph.topology.find_paths(start, end, edge_types, max_length)
+
+    def _chain_path(self, path:tuple[int, ...], start_frame:int, end_frame:int) -> np.ndarray:
+        """Chain the transforms along a path for a block of frames at once.
+
+        Parameters:
+        path (tuple[int, ...]): Tuple of nodes
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+
+        Returns:
+        np.ndarray: Stack of (frames, 4, 4) transforms from the first to the last node of the path
+        """
+        if len(path) == 1:
+            return np.tile(np.eye(4), (end_frame - start_frame, 1, 1))
+        if self.graph.compact:
+            # Chain the stored poses directly and convert to matrices once at the end
+            pose = self.graph.get_poses((path[0], path[1], slice(start_frame, end_frame)))
+            for node1, node2 in zip(path[1:-1], path[2:]):
+                pose = compose_poses(pose, self.graph.get_poses((node1, node2, slice(start_frame, end_frame))))
+            return poses_to_matrices(pose)
+        transform = self.graph[path[0], path[1], start_frame:end_frame]
+        for node1, node2 in zip(path[1:-1], path[2:]):
+            transform = np.matmul(transform, self.graph[node1, node2, start_frame:end_frame])
+        return transform
+
+    def _path_variance(self, path:tuple[int, ...]) -> float:
+        """Get the variance of a path, treating the noise of each edge as an independent standard deviation.
+
+        Parameters:
+        path (tuple[int, ...]): Tuple of nodes
+
+        Returns:
+        float: Sum of the squared noise along the path
+        """
+        return sum(self.graph.get_noise((node1, node2)) ** 2 for node1, node2 in zip(path[:-1], path[1:]))
+
+    def _sum_paths(self, paths:list[tuple[int, ...]], start_frame:int, end_frame:int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Sum the estimates of multiple paths per frame, weighting each path by the inverse of its variance, see _mean_from_sums.
+
+        Parameters:
+        paths (list[tuple[int, ...]]): List of paths between the same two nodes
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+
+        Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Tuple of (frames, 3, 3) weighted rotation sums, (frames, 3) weighted translation sums and (frames,) weight sums
+        """
+        frames = end_frame - start_frame
+        rotation_sum = np.zeros((frames, 3, 3))
+        translation_sum = np.zeros((frames, 3))
+        weight_sum = np.zeros(frames)
+        for path in paths:
+            transform = self._chain_path(path, start_frame, end_frame)
+            # Frames with missing measurements along the path do not contribute
+            valid = ~np.isnan(transform).any(axis=(-2, -1))
+            # A noiseless path should dominate, but must not produce infinite weights
+            weight = valid / max(self._path_variance(path), np.finfo(float).eps)
+            transform = np.where(valid[:, None, None], transform, 0)
+            rotation_sum += weight[:, None, None] * transform[:, :3, :3]
+            translation_sum += weight[:, None] * transform[:, :3, 3]
+            weight_sum += weight
+        return rotation_sum, translation_sum, weight_sum
 
     def _encode_graph(self, frame:int=None):
         """Encode the graph as a JSON compatible dictionary, for use in the viewer.
         """
         # Get the graph as a dictionary
         graph_dict = self.graph.to_dict(frame=frame)
-        
\ No newline at end of file
+
+class LoopClosureSolver(BaseSolver):
+    """Solves non-rigid-unknown edges by fusing every loop of known edges that closes over them.
+
+    Each candidate path between the endpoints of an unknown edge gives an estimate of the edge for every frame.
+    Estimates are fused with weighted least squares, weighting each path by the inverse of its variance:
+    rotations are averaged on SO(3) with the chordal mean and translations with the weighted mean.
+    All frames of the range are solved at once with batched matrix operations.
+
+    In robust mode, each frame starts from the path estimate that the most other paths agree with, and paths are then
+    reweighted with Huber weights on their residuals, so a path broken by a tracking dropout is down-weighted instead of
+    dragging the fused estimate. With a forgetting factor, the noise of known edges is also updated online from the residuals
+    of the paths through them, and the updated noise is used from the next solve on.
+    Residuals are chordal distances, sqrt(|R1 - R2|^2 / 2 + |t1 - t2|^2), in the same units as the noise.
+    """
+
+    # Number of reweighting iterations in robust mode
+    robust_iterations = 3
+
+    def __init__(self, graph:TransformationGraph, max_path_length:int=None, robust:bool=False, inlier_threshold:float=3.0, forgetting:float=None):
+        """Initialize the solver with a graph.
+
+        Parameters:
+        graph (TransformationGraph): Graph to solve
+        max_path_length (int): Maximum number of edges in a candidate path, or None for no limit
+        robust (bool): Whether to down-weight paths that are inconsistent with the others
+        inlier_threshold (float): Residual, in standard deviations of the path, beyond which a path is an outlier
+        forgetting (float): Forgetting factor per frame of the online noise estimates, between 0 and 1, or None to keep the noise of the edges fixed
+        """
+        super().__init__(graph)
+        self.max_path_length = max_path_length
+        self.robust = robust
+        self.inlier_threshold = inlier_threshold
+        self.forgetting = forgetting
+
+    def _solve(self, start_frame:int, end_frame:int):
+        """Solve all non-rigid-unknown edges for the given frame range. Frames without any valid path are set to nan.
+
+        Parameters:
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+        """
+        # Noise samples of the known edges, collected over all unknown edges so that each edge is updated once per solve
+        samples = dict()
+        informative = np.zeros(end_frame - start_frame, dtype=bool)
+        for (node1, node2, edge_type, _) in self.graph.get_all_edges():
+            if edge_type != "non-rigid-unknown":
+                continue
+            paths = self._find_paths(node1, node2, self.max_path_length)
+            if len(paths) > 0 and (self.robust or self.forgetting is not None):
+                self.graph[node1, node2, start_frame:end_frame] = self._fuse_paths_robust(paths, start_frame, end_frame, samples, informative)
+            else:
+                self.graph[node1, node2, start_frame:end_frame] = self._fuse_paths(paths, start_frame, end_frame)
+        if self.forgetting is not None:
+            self._update_noise(samples, np.count_nonzero(informative))
+
+    def _fuse_paths(self, paths:list[tuple[int, ...]], start_frame:int, end_frame:int) -> np.ndarray:
+        """Fuse the estimates of multiple paths with weighted least squares.
+
+        Parameters:
+        paths (list[tuple[int, ...]]): List of paths between the same two nodes
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+
+        Returns:
+        np.ndarray: Stack of (frames, 4, 4) fused transforms
+        """
+        # Unsolvable frames are marked as nan
+        return _mean_from_sums(*self._sum_paths(paths, start_frame, end_frame))
+
+    def _fuse_paths_robust(self, paths:list[tuple[int, ...]], start_frame:int, end_frame:int, samples:dict[tuple[int, int], tuple[float, int]], informative:np.ndarray) -> np.ndarray:
+        """Fuse the estimates of multiple paths, down-weighting outliers in robust mode and collecting noise samples of the edges.
+        Unlike _fuse_paths, this keeps the estimates of all paths in memory at once.
+
+        Parameters:
+        paths (list[tuple[int, ...]]): Non empty list of paths between the same two nodes
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+        samples (dict[tuple[int, int], tuple[float, int]]): Noise samples to add to, see _collect_noise_samples
+        informative (np.ndarray): Boolean mask of the frames that gave noise samples, updated in place
+
+        Returns:
+        np.ndarray: Stack of (frames, 4, 4) fused transforms
+        """
+        transforms = np.stack([self._chain_path(path, start_frame, end_frame) for path in paths])
+        valid = ~np.isnan(transforms).any(axis=(-2, -1))
+        transforms = np.where(valid[..., None, None], transforms, np.eye(4))
+        sigmas = np.sqrt(np.maximum([self._path_variance(path) for path in paths], np.finfo(float).eps))
+        weights = valid / sigmas[:, None] ** 2
+
+        if self.robust:
+            fused = self._consensus(transforms, valid, sigmas)
+            for _ in range(self.robust_iterations):
+                residuals = np.nan_to_num(_chordal_distance(fused[None], transforms)) / sigmas[:, None]
+                huber = np.minimum(1, self.inlier_threshold / np.maximum(residuals, np.finfo(float).tiny))
+                fused = _weighted_mean(transforms, weights * huber)
+        else:
+            fused = _weighted_mean(transforms, weights)
+
+        if self.forgetting is not None:
+            informative |= self._collect_noise_samples(paths, transforms, valid, sigmas, fused, samples)
+        return fused
+
+    def _consensus(self, transforms:np.ndarray, valid:np.ndarray, sigmas:np.ndarray) -> np.ndarray:
+        """Pick, for every frame, the path estimate that the most other paths agree with, as in RANSAC with every path as a candidate.
+
+        Parameters:
+        transforms (np.ndarray): Array of (paths, frames, 4, 4) estimates
+        valid (np.ndarray): Array of (paths, frames) booleans, False where a path has missing measurements
+        sigmas (np.ndarray): Standard deviation of each path
+
+        Returns:
+        np.ndarray: Stack of (frames, 4, 4) estimates, nan where no path is valid
+        """
+        agreement = np.empty(valid.shape, dtype=int)
+        for i in range(len(transforms)):
+            distance = _chordal_distance(transforms[i][None], transforms) / np.sqrt(sigmas[i] ** 2 + sigmas ** 2)[:, None]
+            agreement[i] = np.count_nonzero(valid & (distance <= self.inlier_threshold), axis=0)
+        agreement[~valid] = -1
+        # Ties go to the path with the lowest variance
+        order = np.argsort(sigmas, kind="stable")
+        best = order[np.argmax(agreement[order], axis=0)]
+        result = transforms[best, np.arange(valid.shape[1])]
+        result[~valid.any(axis=0)] = np.nan
+        return result
+
+    def _collect_noise_samples(self, paths:list[tuple[int, ...]], transforms:np.ndarray, valid:np.ndarray, sigmas:np.ndarray, fused:np.ndarray, samples:dict[tuple[int, int], tuple[float, int]]) -> np.ndarray:
+        """Collect samples of the variance of the edges along the paths from the residuals of the paths.
+
+        The variance of a path is estimated as its mean squared residual plus the variance of the fused estimate, which the
+        residual does not see, and is shared among the edges of the path in proportion to their current variance. Residuals
+        are clipped at the inlier threshold so that outliers do not inflate the noise.
+
+        Parameters:
+        paths (list[tuple[int, ...]]): List of paths
+        transforms (np.ndarray): Array of (paths, frames, 4, 4) estimates
+        valid (np.ndarray): Array of (paths, frames) booleans, False where a path has missing measurements
+        sigmas (np.ndarray): Standard deviation of each path
+        fused (np.ndarray): Stack of (frames, 4, 4) fused estimates
+        samples (dict[tuple[int, int], tuple[float, int]]): Dictionary of edge to (sum of variance samples, number of samples), updated in place
+
+        Returns:
+        np.ndarray: Boolean mask of the frames that gave samples
+        """
+        # A single path agrees with itself, so frames with fewer than two valid paths say nothing about the noise
+        informative = valid & (np.count_nonzero(valid, axis=0) >= 2)
+        if not np.any(informative):
+            return np.any(informative, axis=0)
+        residuals = np.minimum(np.nan_to_num(_chordal_distance(fused[None], transforms)), self.inlier_threshold * sigmas[:, None])
+        fused_variance = 1 / np.maximum(np.sum(valid / sigmas[:, None] ** 2, axis=0), np.finfo(float).tiny)
+        path_variances = residuals ** 2 + fused_variance
+
+        # Accumulate the samples of each edge over all paths through it
+        for path, variance, frames in zip(paths, path_variances, informative):
+            count = np.count_nonzero(frames)
+            if count == 0:
+                continue
+            mean = variance[frames].mean()
+            edges = list(zip(path[:-1], path[1:]))
+            edge_variances = np.array([self.graph.get_noise(edge) ** 2 for edge in edges])
+            total = edge_variances.sum()
+            shares = edge_variances / total if total > 0 else np.full(len(edges), 1 / len(edges))
+            for edge, share in zip(edges, shares):
+                key = (min(edge), max(edge))
+                sample_sum, sample_count = samples.get(key, (0.0, 0))
+                samples[key] = (sample_sum + share * mean * count, sample_count + count)
+        return np.any(informative, axis=0)
+
+    def _update_noise(self, samples:dict[tuple[int, int], tuple[float, int]], frames:int):
+        """Update the noise of the edges from the samples collected during a solve, with exponential forgetting.
+
+        Parameters:
+        samples (dict[tuple[int, int], tuple[float, int]]): Dictionary of edge to (sum of variance samples, number of samples)
+        frames (int): Number of frames that gave samples, over which the previous noise is forgotten
+        """
+        decay = self.forgetting ** frames
+        for key, (sample_sum, sample_count) in samples.items():
+            variance = decay * self.graph.get_noise(key) ** 2 + (1 - decay) * sample_sum / sample_count
+            self.graph.set_noise(key, np.sqrt(variance))
+
+def _chordal_distance(T1:np.ndarray, T2:np.ndarray) -> np.ndarray:
+    """Get the chordal distances sqrt(|R1 - R2|^2 / 2 + |t1 - t2|^2) between two broadcastable stacks of rigid transforms.
+    """
+    rotation = np.sum((T1[..., :3, :3] - T2[..., :3, :3]) ** 2, axis=(-2, -1)) / 2
+    translation = np.sum((T1[..., :3, 3] - T2[..., :3, 3]) ** 2, axis=-1)
+    return np.sqrt(rotation + translation)
+
+def _weighted_mean(transforms:np.ndarray, weights:np.ndarray) -> np.ndarray:
+    """Fuse stacks of rigid transforms with the chordal mean of their rotations and the weighted mean of their translations.
+
+    Parameters:
+    transforms (np.ndarray): Array of (paths, frames, 4, 4) transforms
+    weights (np.ndarray): Array of (paths, frames) weights
+
+    Returns:
+    np.ndarray: Stack of (frames, 4, 4) fused transforms, nan where all weights are zero
+    """
+    rotation_sum = np.einsum("pf,pfij->fij", weights, transforms[..., :3, :3])
+    translation_sum = np.einsum("pf,pfi->fi", weights, transforms[..., :3, 3])
+    return _mean_from_sums(rotation_sum, translation_sum, weights.sum(axis=0))
+
+def _mean_from_sums(rotation_sum:np.ndarray, translation_sum:np.ndarray, weight_sum:np.ndarray) -> np.ndarray:
+    """Turn weighted sums of rigid transforms into their chordal mean rotations and weighted mean translations.
+
+    Parameters:
+    rotation_sum (np.ndarray): Array of (frames, 3, 3) weighted sums of rotations
+    translation_sum (np.ndarray): Array of (frames, 3) weighted sums of translations
+    weight_sum (np.ndarray): Array of (frames,) sums of weights
+
+    Returns:
+    np.ndarray: Stack of (frames, 4, 4) mean transforms, nan where the weight sum is zero
+    """
+    solved = weight_sum > 0
+    result = np.full((len(weight_sum), 4, 4), np.nan)
+    result[solved] = np.eye(4)
+    result[solved, :3, :3] = project_to_rotation(rotation_sum[solved])
+    result[solved, :3, 3] = translation_sum[solved] / weight_sum[solved, None]
+    return result
+
+def _quaternion_left_matrix(q:np.ndarray) -> np.ndarray:
+    """Get the matrices L(q) such that q * p = L(q) p, for a stack of (..., 4) quaternions in (w, x, y, z) order.
+    """
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    return np.stack([
+        np.stack([w, -x, -y, -z], axis=-1),
+        np.stack([x, w, -z, y], axis=-1),
+        np.stack([y, z, w, -x], axis=-1),
+        np.stack([z, -y, x, w], axis=-1),
+    ], axis=-2)
+
+def _quaternion_right_matrix(q:np.ndarray) -> np.ndarray:
+    """Get the matrices R(q) such that p * q = R(q) p, for a stack of (..., 4) quaternions in (w, x, y, z) order.
+    """
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    return np.stack([
+        np.stack([w, -x, -y, -z], axis=-1),
+        np.stack([x, w, z, -y], axis=-1),
+        np.stack([y, -z, w, x], axis=-1),
+        np.stack([z, y, -x, w], axis=-1),
+    ], axis=-2)
+
+def _hand_eye_terms(A:np.ndarray, B:np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Get the sufficient statistics contributed by a stack of (..., 4, 4) motion pairs to the AX = XB problem.
+
+    Rotation: q_A * q_X = q_X * q_B, so (L(q_A) - R(q_B)) q_X = 0 and M = K^T K is accumulated.
+    Translation: (R_A - I) t_X = R_X t_B - t_A, so with C = R_A - I the normal equations are
+    C^T C t_X = C^T R_X t_B - C^T t_A, where C^T R_X t_B = (t_B^T kron C^T) vec(R_X) is linear in R_X.
+
+    Returns:
+    tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Tuple of (M, H, G, h) with shapes (..., 4, 4), (..., 3, 3), (..., 3, 9) and (..., 3)
+    """
+    q_A = rotation_to_quaternion(A[..., :3, :3])
+    q_B = rotation_to_quaternion(B[..., :3, :3])
+    # Both motions rotate by the same angle, so pick the sign of q_B that makes the scalar parts agree
+    q_B = q_B * np.where(q_A[..., :1] * q_B[..., :1] < 0, -1, 1)
+    K = _quaternion_left_matrix(q_A) - _quaternion_right_matrix(q_B)
+    M = np.swapaxes(K, -1, -2) @ K
+    C = A[..., :3, :3] - np.eye(3)
+    H = np.swapaxes(C, -1, -2) @ C
+    # Column j * 3 + m of G is t_B[j] * C^T[:, m], matching the column-major vec(R_X)
+    G = np.einsum("...j,...mi->...ijm", B[..., :3, 3], C).reshape(C.shape[:-2] + (3, 9))
+    h = np.einsum("...mi,...m->...i", C, A[..., :3, 3])
+    return M, H, G, h
+
+def _estimate_hand_eye(M:np.ndarray, H:np.ndarray, G:np.ndarray, h:np.ndarray) -> np.ndarray:
+    """Solve AX = XB from accumulated sufficient statistics, batched over any leading dimensions.
+
+    Returns:
+    np.ndarray: Stack of (..., 4, 4) estimates of X
+    """
+    # The rotation is the eigenvector of the smallest eigenvalue, eigh sorts them in ascending order
+    _, vectors = np.linalg.eigh(M)
+    R_X = quaternion_to_rotation(vectors[..., :, 0])
+    vec_R_X = np.swapaxes(R_X, -1, -2).reshape(R_X.shape[:-2] + (9,))
+    # The pseudo inverse keeps the translation finite when all rotation axes are parallel
+    t_X = (np.linalg.pinv(H) @ ((G @ vec_R_X[..., None])[..., 0] - h)[..., None])[..., 0]
+    X = np.zeros(R_X.shape[:-2] + (4, 4))
+    X[..., :3, :3] = R_X
+    X[..., :3, 3] = t_X
+    X[..., 3, 3] = 1
+    return X
+
+class HandEyeEstimator(object):
+    """Incremental estimator for X in AX = XB, where A and B are relative motions observed on either side of X.
+
+    Only running sums of the normal equations are kept, so adding a motion is O(1) regardless of how many have been seen.
+    With a window, the contributions of the last window motions are kept so the oldest can be subtracted out again.
+    """
+
+    def __init__(self, window:int=None):
+        """Initialize the estimator.
+
+        Parameters:
+        window (int): Number of most recent motions to estimate from, at least 2, or None to use all motions
+        """
+        # A single motion does not determine X, so a window of one motion would never give an estimate
+        if window is not None and window < 2:
+            raise Exception("Window must be at least 2")
+        self.window = window
+        self._statistics = (np.zeros((4, 4)), np.zeros((3, 3)), np.zeros((3, 9)), np.zeros(3))
+        self._history = deque()
+        self._num_motions = 0
+        # Previous pair of poses, used to form motions from consecutive frames
+        self._previous = None
+
+    def add_frame(self, P:np.ndarray, Q:np.ndarray):
+        """Add a frame where X = P Y Q for some unknown constant Y, forming a motion with the previous frame.
+
+        Parameters:
+        P (np.ndarray): 4x4 transform on the left of Y
+        Q (np.ndarray): 4x4 transform on the right of Y
+        """
+        if self._previous is not None:
+            # From P_i^-1 X Q_i^-1 = P_j^-1 X Q_j^-1 it follows that (P_j P_i^-1) X = X (Q_j^-1 Q_i)
+            P_previous, Q_previous = self._previous
+            self.add_motion(P @ np.linalg.inv(P_previous), np.linalg.inv(Q) @ Q_previous)
+        self._previous = (P, Q)
+
+    def add_motion(self, A:np.ndarray, B:np.ndarray):
+        """Add a single motion pair.
+
+        Parameters:
+        A (np.ndarray): 4x4 motion on the left of X
+        B (np.ndarray): 4x4 motion on the right of X
+        """
+        self._add_terms(_hand_eye_terms(A, B))
+
+    def _add_terms(self, terms:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]):
+        """Add the precomputed sufficient statistics of a single motion, evicting the oldest one if the window is full.
+        """
+        self._statistics = tuple(total + term for total, term in zip(self._statistics, terms))
+        self._num_motions += 1
+        if self.window is not None:
+            self._history.append(terms)
+            if len(self._history) > self.window:
+                self._statistics = tuple(total - term for total, term in zip(self._statistics, self._history.popleft()))
+                self._num_motions -= 1
+
+    def estimate(self) -> np.ndarray:
+        """Get the current estimate of X.
+
+        Returns:
+        np.ndarray: 4x4 transform, or all nan if fewer than two motions have been seen
+        """
+        if self._num_motions < 2:
+            return np.full((4, 4), np.nan)
+        return _estimate_hand_eye(*self._statistics)
+
+    @property
+    def num_motions(self) -> int:
+        """Get the number of motions currently contributing to the estimate
+
+        Returns:
+        int: Number of motions
+        """
+        return self._num_motions
+
+class RigidMeanEstimator(object):
+    """Incremental estimator of a constant transform observed directly in every frame, fusing the observations with the
+    chordal mean of their rotations and the weighted mean of their translations, as LoopClosureSolver does within a frame.
+
+    Only running sums are kept, so adding a frame is O(1). With a window, the contributions of the last window frames are
+    kept so the oldest can be subtracted out again.
+    """
+
+    def __init__(self, window:int=None):
+        """Initialize the estimator.
+
+        Parameters:
+        window (int): Number of most recent frames to estimate from, or None to use all frames
+        """
+        if window is not None and window < 1:
+            raise Exception("Window must be at least 1")
+        self.window = window
+        self._statistics = (np.zeros((3, 3)), np.zeros(3), 0.0)
+        self._history = deque()
+        self._num_frames = 0
+
+    def _add_terms(self, terms:tuple[np.ndarray, np.ndarray, float]):
+        """Add the weighted rotation, weighted translation and weight of a single frame, evicting the oldest one if the window is full.
+        """
+        self._statistics = tuple(total + term for total, term in zip(self._statistics, terms))
+        self._num_frames += 1
+        if self.window is not None:
+            self._history.append(terms)
+            if len(self._history) > self.window:
+                self._statistics = tuple(total - term for total, term in zip(self._statistics, self._history.popleft()))
+                self._num_frames -= 1
+
+    def estimate(self) -> np.ndarray:
+        """Get the current estimate.
+
+        Returns:
+        np.ndarray: 4x4 transform, or all nan if no frame has been seen
+        """
+        if self._num_frames == 0:
+            return np.full((4, 4), np.nan)
+        return _mean_from_sums(*(np.asarray(total)[None] for total in self._statistics))[0]
+
+    @property
+    def num_frames(self) -> int:
+        """Get the number of frames currently contributing to the estimate
+
+        Returns:
+        int: Number of frames
+        """
+        return self._num_frames
+
+class HandEyeSolver(BaseSolver):
+    """Solves rigid-unknown edges as an AX = XB problem over a time window.
+
+    For a rigid-unknown edge X between two nodes, a loop is searched that closes over X through known edges and exactly one
+    other rigid-unknown edge Y, so that X = P(t) Y Q(t) with P and Q chained from known edges. Relative motions between
+    consecutive frames cancel out Y, leaving AX = XB. Each edge keeps a HandEyeEstimator across calls to solve, so solving
+    frame after frame, as in a live session, costs O(1) per frame. Every frame receives the estimate from the motions seen
+    up to and including it.
+
+    A rigid-unknown edge that is closed by known edges alone is observed directly in every frame, so no motion is needed:
+    the paths of known edges between its nodes are fused over the window with a RigidMeanEstimator instead, weighting each
+    path by the inverse of its variance. Such loops take precedence over loops through another rigid-unknown edge.
+    """
+
+    def __init__(self, graph:TransformationGraph, window:int=None, max_path_length:int=None):
+        """Initialize the solver with a graph.
+
+        Parameters:
+        graph (TransformationGraph): Graph to solve
+        window (int): Number of most recent motions to estimate each edge from, at least 2, or None to use all motions
+        max_path_length (int): Maximum number of edges in a loop, or None for no limit
+        """
+        super().__init__(graph)
+        # Checked here rather than when the first estimator is created, see HandEyeEstimator
+        if window is not None and window < 2:
+            raise Exception("Window must be at least 2")
+        self.window = window
+        self.max_path_length = max_path_length
+        self._estimators = dict()
+        self._loops = dict()
+
+    def _solve(self, start_frame:int, end_frame:int):
+        """Solve all rigid-unknown edges for the given frame range, continuing from the frames seen by previous calls.
+
+        Parameters:
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+        """
+        for (node1, node2, edge_type, _) in self.graph.get_all_edges():
+            if edge_type != "rigid-unknown":
+                continue
+            paths = self._find_paths(node1, node2, self.max_path_length)
+            if len(paths) > 0:
+                estimator = self._get_estimator((node1, node2), RigidMeanEstimator)
+                self.graph[node1, node2, start_frame:end_frame] = self._update_mean_estimator(estimator, paths, start_frame, end_frame)
+                continue
+            loop = self._find_loop(node1, node2)
+            if loop is None:
+                # Unsolvable
+                self.graph[node1, node2, start_frame:end_frame] = np.full((end_frame - start_frame, 4, 4), np.nan)
+                continue
+            estimator = self._get_estimator((node1, node2), HandEyeEstimator)
+            P = self._chain_path(loop[0], start_frame, end_frame)
+            Q = self._chain_path(loop[1], start_frame, end_frame)
+            self.graph[node1, node2, start_frame:end_frame] = self._update_estimator(estimator, P, Q)
+
+    def _get_estimator(self, edge:tuple[int, int], estimator_type:type) -> object:
+        """Get the estimator of an edge, starting a new one if the edge has none yet.
+
+        Parameters:
+        edge (tuple[int, int]): Edge
+        estimator_type (type): HandEyeEstimator or RigidMeanEstimator
+
+        Returns:
+        object: Estimator of the edge
+        """
+        if edge not in self._estimators:
+            self._estimators[edge] = estimator_type(self.window)
+        return self._estimators[edge]
+
+    def _find_loop(self, node1:int, node2:int) -> tuple[tuple[int, ...], tuple[int, ...]]:
+        """Find the shortest loop closing over a rigid-unknown edge through known edges and one other rigid-unknown edge.
+        Loops are cached, as the edges of a graph do not change.
+
+        Parameters:
+        node1 (int): First node of the edge
+        node2 (int): Second node of the edge
+
+        Returns:
+        tuple[tuple[int, ...], tuple[int, ...]]: Tuple of paths (node1 to the start of Y, end of Y to node2), or None if there is no such loop
+        """
+        if (node1, node2) not in self._loops:
+            self._loops[(node1, node2)] = self._search_loop(node1, node2)
+        return self._loops[(node1, node2)]
+
+    def _search_loop(self, node1:int, node2:int) -> tuple[tuple[int, ...], tuple[int, ...]]:
+        """Search the paths between the nodes of a rigid-unknown edge for the shortest loop, see _find_loop.
+        """
+        best = None
+        for path in self._find_paths(node1, node2, self.max_path_length, KNOWN_TYPES + ("rigid-unknown",)):
+            unknown = [i for i in range(len(path) - 1) if self.graph.get_type((path[i], path[i + 1])) == "rigid-unknown"]
+            if len(unknown) != 1 or len(path) == 2:
+                continue
+            if best is None or len(path) < len(best[0]) + len(best[1]):
+                best = (path[:unknown[0] + 1], path[unknown[0] + 1:])
+        return best
+
+    def _update_estimator(self, estimator:HandEyeEstimator, P:np.ndarray, Q:np.ndarray) -> np.ndarray:
+        """Feed a block of frames into an estimator and get the estimate after each frame.
+
+        Parameters:
+        estimator (HandEyeEstimator): Estimator of the edge
+        P (np.ndarray): Stack of (frames, 4, 4) transforms on the left of Y
+        Q (np.ndarray): Stack of (frames, 4, 4) transforms on the right of Y
+
+        Returns:
+        np.ndarray: Stack of (frames, 4, 4) estimates
+        """
+        frames = P.shape[0]
+        valid = ~(np.isnan(P).any(axis=(-2, -1)) | np.isnan(Q).any(axis=(-2, -1)))
+        indices = np.flatnonzero(valid)
+
+        # Form the motions between consecutive valid frames, including the last frame of the previous call, all at once
+        if estimator._previous is not None:
+            P_all = np.concatenate([estimator._previous[0][None], P[indices]])
+            Q_all = np.concatenate([estimator._previous[1][None], Q[indices]])
+            motion_frames = indices
+        else:
+            P_all, Q_all = P[indices], Q[indices]
+            motion_frames = indices[1:]
+        A = P_all[1:] @ np.linalg.inv(P_all[:-1])
+        B = np.linalg.inv(Q_all[1:]) @ Q_all[:-1]
+        terms = _hand_eye_terms(A, B)
+        if len(indices) > 0:
+            estimator._previous = (P[indices[-1]], Q[indices[-1]])
+
+        # Accumulate one motion at a time, snapshotting the statistics after every frame
+        snapshots = tuple(np.empty((frames,) + total.shape) for total in estimator._statistics)
+        counts = np.empty(frames, dtype=int)
+        motion = 0
+        for frame in range(frames):
+            if motion < len(motion_frames) and motion_frames[motion] == frame:
+                estimator._add_terms(tuple(term[motion] for term in terms))
+                motion += 1
+            for snapshot, total in zip(snapshots, estimator._statistics):
+                snapshot[frame] = total
+            counts[frame] = estimator.num_motions
+
+        # Solve all snapshots at once
+        estimates = _estimate_hand_eye(*snapshots)
+        estimates[counts < 2] = np.nan
+        return estimates
+
+    def _update_mean_estimator(self, estimator:RigidMeanEstimator, paths:list[tuple[int, ...]], start_frame:int, end_frame:int) -> np.ndarray:
+        """Feed the paths of known edges over a block of frames into an estimator and get the estimate after each frame.
+
+        Parameters:
+        estimator (RigidMeanEstimator): Estimator of the edge
+        paths (list[tuple[int, ...]]): Non empty list of paths of known edges between the nodes of the edge
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+
+        Returns:
+        np.ndarray: Stack of (frames, 4, 4) estimates
+        """
+        frames = end_frame - start_frame
+        terms = self._sum_paths(paths, start_frame, end_frame)
+
+        # Accumulate one frame at a time, snapshotting the statistics after every frame
+        snapshots = tuple(np.empty((frames,) + np.shape(total)) for total in estimator._statistics)
+        for frame in range(frames):
+            if terms[2][frame] > 0:
+                estimator._add_terms(tuple(term[frame] for term in terms))
+            for snapshot, total in zip(snapshots, estimator._statistics):
+                snapshot[frame] = total
+
+        # Solve all snapshots at once, frames before the first valid one have a weight sum of zero and stay nan
+        return _mean_from_sums(*snapshots)
+
+class BundleAdjustmentSolver(BaseSolver):
+    """Refines every unknown edge at once by minimizing the loop closure error over all loops and frames.
+
+    Each fundamental cycle of the graph that contains an unknown edge gives a residual per frame, the twist of the transform
+    chained around the loop, which is the identity when the loop closes perfectly. Residuals are weighted by the inverse of the
+    loop standard deviation. Unknown edges are parameterized on the Lie algebra as X = X0 exp(xi), with one twist per
+    rigid-unknown edge and one twist per frame for non-rigid-unknown edges. The current values of the edges are used as X0, so
+    the other solvers must be run first to provide a starting point. Frames without one start from the identity but are left
+    unsolved, since loops made only of unknown edges do not determine them.
+
+    scipy.optimize.least_squares is given the sparsity pattern of the Jacobian, so finite differences only need a handful of
+    evaluations per iteration regardless of the number of frames, and the cost scales linearly with frames.
+    """
+
+    def __init__(self, graph:TransformationGraph, max_evaluations:int=None, tolerance:float=1e-8):
+        """Initialize the solver with a graph.
+
+        Parameters:
+        graph (TransformationGraph): Graph to solve
+        max_evaluations (int): Maximum number of residual evaluations, or None for the least_squares default
+        tolerance (float): Tolerance on the change of the cost and of the parameters for termination
+        """
+        super().__init__(graph)
+        self.max_evaluations = max_evaluations
+        self.tolerance = tolerance
+
+    def _solve(self, start_frame:int, end_frame:int):
+        """Refine all unknown edges for the given frame range.
+
+        Parameters:
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+
+        Returns:
+        scipy.optimize.OptimizeResult: Result of the optimization, or None if there is nothing to refine
+        """
+        import scipy.optimize
+
+        frames = end_frame - start_frame
+
+        # Lay out the parameters, one block of 6 per rigid-unknown edge and per frame of non-rigid-unknown edges
+        offsets = dict()
+        initial = dict()
+        estimated = dict()
+        num_parameters = 0
+        for (node1, node2, edge_type, _) in self.graph.get_all_edges():
+            if edge_type not in UNKNOWN_TYPES:
+                continue
+            offsets[(node1, node2)] = num_parameters
+            values = self.graph[node1, node2, start_frame:end_frame].copy()
+            solved = ~np.isnan(values).any(axis=(-2, -1))
+            estimated[(node1, node2)] = solved if edge_type == "non-rigid-unknown" else np.full(frames, np.any(solved))
+            if edge_type == "rigid-unknown":
+                initial[(node1, node2)] = values[np.argmax(solved)] if np.any(solved) else np.eye(4)
+                num_parameters += 6
+            else:
+                values[~solved] = np.eye(4)
+                initial[(node1, node2)] = values
+                num_parameters += 6 * frames
+
+        loops = [self._build_loop(cycle, offsets, start_frame, end_frame) for cycle in self.graph.topology.get_cycles()]
+        loops = [loop for loop in loops if loop is not None]
+        if len(loops) == 0:
+            return None
+
+        def unpack(parameters:np.ndarray) -> dict[tuple[int, int], np.ndarray]:
+            edges = dict()
+            for key, offset in offsets.items():
+                if initial[key].ndim == 2:
+                    edges[key] = initial[key] @ se3_exp(parameters[offset:offset + 6])
+                else:
+                    edges[key] = initial[key] @ se3_exp(parameters[offset:offset + 6 * frames].reshape(frames, 6))
+            return edges
+
+        def residuals(parameters:np.ndarray) -> np.ndarray:
+            edges = unpack(parameters)
+            result = np.empty((len(loops), frames, 6))
+            for i, (steps, weights) in enumerate(loops):
+                transform = np.eye(4)
+                for (known, key, inverted) in steps:
+                    if known is not None:
+                        transform = transform @ known
+                    else:
+                        transform = transform @ (invert_rigid_transform(edges[key]) if inverted else edges[key])
+                result[i] = se3_log(np.broadcast_to(transform, (frames, 4, 4))) * weights[:, None]
+            return result.ravel()
+
+        result = scipy.optimize.least_squares(
+            residuals, np.zeros(num_parameters), jac_sparsity=self._jacobian_sparsity(loops, offsets, initial, frames, num_parameters),
+            method="trf", x_scale="jac", ftol=self.tolerance, xtol=self.tolerance, max_nfev=self.max_evaluations,
+        )
+
+        # Frames without an initial estimate are not observable on their own, so they are left unsolved
+        for key, value in unpack(result.x).items():
+            value = np.broadcast_to(value, (frames, 4, 4))
+            self.graph[key[0], key[1], start_frame:end_frame] = np.where(estimated[key][:, None, None], value, np.nan)
+        return result
+
+    def _build_loop(self, cycle:tuple[int, ...], offsets:dict[tuple[int, int], int], start_frame:int, end_frame:int) -> tuple[list, np.ndarray]:
+        """Prepare the steps around a cycle, with consecutive known edges chained ahead of time.
+
+        Parameters:
+        cycle (tuple[int, ...]): Tuple of nodes that starts and ends at the same node
+        offsets (dict[tuple[int, int], int]): Parameter offsets of the unknown edges
+        start_frame (int): First frame
+        end_frame (int): Frame after the last frame
+
+        Returns:
+        tuple[list, np.ndarray]: Tuple of (steps, weights), where each step is (known transforms, None, None) or (None, unknown edge, inverted), or None if the cycle has no unknown edge
+        """
+        steps = []
+        known = None
+        valid = np.ones(end_frame - start_frame, dtype=bool)
+        for node1, node2 in zip(cycle[:-1], cycle[1:]):
+            key = (node1, node2) if (node1, node2) in offsets else (node2, node1)
+            if key in offsets:
+                if known is not None:
+                    steps.append((known, None, None))
+                    known = None
+                steps.append((None, key, key != (node1, node2)))
+                continue
+            transform = self.graph[node1, node2, start_frame:end_frame]
+            # Frames with missing measurements do not contribute
+            missing = np.isnan(transform).any(axis=(-2, -1))
+            valid &= ~missing
+            transform = np.where(missing[:, None, None], np.eye(4), transform)
+            known = transform if known is None else known @ transform
+        if known is not None:
+            steps.append((known, None, None))
+        if all(step[0] is not None for step in steps):
+            return None
+        weights = valid / np.sqrt(max(self._path_variance(cycle), np.finfo(float).eps))
+        return steps, weights
+
+    def _jacobian_sparsity(self, loops:list, offsets:dict[tuple[int, int], int], initial:dict[tuple[int, int], np.ndarray], frames:int, num_parameters:int) -> "scipy.sparse.coo_matrix":
+        """Build the sparsity pattern of the Jacobian: the residuals of a loop at a frame only depend on the twist of each
+        rigid-unknown edge in the loop and on the twist of each non-rigid-unknown edge in the loop at the same frame.
+
+        Returns:
+        scipy.sparse.coo_matrix: Matrix of (residuals, parameters) with ones where the Jacobian may be non zero
+        """
+        import scipy.sparse
+
+        rows = []
+        columns = []
+        # Rows and columns of a 6x6 block for every frame
+        frame_rows = (np.arange(frames)[:, None, None] * 6 + np.arange(6)[None, :, None]) + np.zeros((1, 1, 6), dtype=int)
+        block_columns = np.arange(6)[None, None, :] + np.zeros((frames, 6, 1), dtype=int)
+        for i, (steps, _) in enumerate(loops):
+            for (_, key, _) in steps:
+                if key is None:
+                    continue
+                rows.append((i * frames * 6 + frame_rows).ravel())
+                if initial[key].ndim == 2:
+                    columns.append((offsets[key] + block_columns).ravel())
+                else:
+                    columns.append((offsets[key] + np.arange(frames)[:, None, None] * 6 + block_columns).ravel())
+        rows = np.concatenate(rows)
+        columns = np.concatenate(columns)
+        return scipy.sparse.coo_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(loops) * frames * 6, num_parameters))
@@ -1,33 +1,37 @@
+# Only NumPy is imported at module load, SciPy and Matplotlib are imported by the functions that need them
 import numpy as np
-import quaternion
-import matplotlib.pyplot as plt
-import scipy
-import scipy.optimize
 
-def generate_random_transform():
+def generate_random_transform(rng: np.random.Generator = None):
     # Create random 4x4 affine transformation matrix with random rotation and translation
-    # Rotation is a random quaternion
-    # Translation is a random vector
+    return generate_random_transforms(1, rng)[0]
+
+def generate_random_transforms(num: int, rng: np.random.Generator = None):
+    # Create a stack of num random 4x4 affine transformation matrices with random rotation and translation
+    # Rotation is uniformly distributed over SO(3)
+    # Translation is a random vector in [-1, 1)^3
     # Scale will be 1
     # Shear will be 0
+    # Pass a seeded np.random.default_rng(seed) as rng for reproducible results
+    if rng is None:
+        rng = np.random.default_rng()
 
-    # Create random rotation matrix
-    R = scipy.spatial.transform.Rotation.random().as_matrix()
+    from scipy.spatial.transform import Rotation
 
-    # Create random translation vector
-    t = (np.random.rand(3) - 0.5) * 2
+    # Create random rotation matrices
+    R = Rotation.random(num, random_state=rng).as_matrix()
 
-    # Scale is 1
-    s = 1
+    # Create random translation vectors
+    t = (rng.random((num, 3)) - 0.5) * 2
 
-    # Create matrix
-    M = np.eye(4)
-    M[:3, :3] = R
-    M[:3, 3] = t
-    M[3, 3] = s
+    # Create matrices, scale is 1
+    M = np.tile(np.eye(4), (num, 1, 1))
+    M[:, :3, :3] = R
+    M[:, :3, 3] = t
     return M
 
 def visualize_transform(T: list[np.ndarray]):
+    import matplotlib.pyplot as plt
+
     # 3D plot
     fig = plt.figure()
     ax = fig.add_subplot(111, projection='3d')
@@ -73,4 +77,175 @@ def calc_relative_transform(from_transform: np.ndarray, to_transform: np.ndarray
     # from_transform is the transform that we are starting from
     # to_transform is the transform that we are ending at
     # Returns the relative transform
-    return np.linalg.inv(from_transform) @ to_transform
\ No newline at end of file
+    # Works on stacks of transforms (..., 4, 4) as well
+    return invert_rigid_transform(from_transform) @ to_transform
+
+def project_to_rotation(M: np.ndarray) -> np.ndarray:
+    # Project a stack of 3x3 matrices (..., 3, 3) onto the closest rotation matrices in the Frobenius sense
+    # This is the chordal L2 mean when M is a weighted sum of rotation matrices
+    U, _, Vt = np.linalg.svd(M)
+    # Flip the last singular vector where needed so the result is a proper rotation (det = 1) rather than a reflection
+    D = np.ones(M.shape[:-1])
+    D[..., -1] = np.sign(np.linalg.det(U @ Vt))
+    return (U * D[..., None, :]) @ Vt
+
+def rotation_to_quaternion(R: np.ndarray) -> np.ndarray:
+    # Convert a stack of rotation matrices (..., 3, 3) to unit quaternions (..., 4) in (w, x, y, z) order, with w >= 0
+    # Each of the four components is tried as the pivot and the largest one is kept for numerical stability
+    R = np.asarray(R, dtype=float)
+    m00, m01, m02 = R[..., 0, 0], R[..., 0, 1], R[..., 0, 2]
+    m10, m11, m12 = R[..., 1, 0], R[..., 1, 1], R[..., 1, 2]
+    m20, m21, m22 = R[..., 2, 0], R[..., 2, 1], R[..., 2, 2]
+    pivots = np.stack([1 + m00 + m11 + m22, 1 + m00 - m11 - m22, 1 - m00 + m11 - m22, 1 - m00 - m11 + m22], axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        s = np.sqrt(np.maximum(pivots, 0)) * 2
+        candidates = np.stack([
+            np.stack([s[..., 0] / 4, (m21 - m12) / s[..., 0], (m02 - m20) / s[..., 0], (m10 - m01) / s[..., 0]], axis=-1),
+            np.stack([(m21 - m12) / s[..., 1], s[..., 1] / 4, (m01 + m10) / s[..., 1], (m02 + m20) / s[..., 1]], axis=-1),
+            np.stack([(m02 - m20) / s[..., 2], (m01 + m10) / s[..., 2], s[..., 2] / 4, (m12 + m21) / s[..., 2]], axis=-1),
+            np.stack([(m10 - m01) / s[..., 3], (m02 + m20) / s[..., 3], (m12 + m21) / s[..., 3], s[..., 3] / 4], axis=-1),
+        ], axis=-2)
+    best = np.argmax(pivots, axis=-1)
+    q = np.take_along_axis(candidates, best[..., None, None], axis=-2)[..., 0, :]
+    return q * np.where(q[..., :1] < 0, -1, 1)
+
+def quaternion_to_rotation(q: np.ndarray) -> np.ndarray:
+    # Convert a stack of quaternions (..., 4) in (w, x, y, z) order to rotation matrices (..., 3, 3)
+    q = np.asarray(q, dtype=float)
+    q = q / np.linalg.norm(q, axis=-1, keepdims=True)
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)], axis=-1),
+        np.stack([2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)], axis=-1),
+        np.stack([2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)], axis=-1),
+    ], axis=-2)
+
+def invert_rigid_transform(T: np.ndarray) -> np.ndarray:
+    # Invert a stack of rigid transforms (..., 4, 4) in closed form, using (R, t)^-1 = (R^T, -R^T t) instead of a general inversion
+    R_inv = np.swapaxes(T[..., :3, :3], -1, -2)
+    T_inv = np.zeros_like(T)
+    T_inv[..., :3, :3] = R_inv
+    T_inv[..., :3, 3] = -(R_inv @ T[..., :3, 3, None])[..., 0]
+    T_inv[..., 3, :] = T[..., 3, :]
+    return T_inv
+
+def skew(v: np.ndarray) -> np.ndarray:
+    # Skew symmetric matrices (..., 3, 3) of a stack of vectors (..., 3), so that skew(a) @ b = cross(a, b)
+    x, y, z = v[..., 0], v[..., 1], v[..., 2]
+    zero = np.zeros_like(x)
+    return np.stack([
+        np.stack([zero, -z, y], axis=-1),
+        np.stack([z, zero, -x], axis=-1),
+        np.stack([-y, x, zero], axis=-1),
+    ], axis=-2)
+
+def _so3_coefficients(theta: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Coefficients sin(t) / t, (1 - cos(t)) / t^2 and (t - sin(t)) / t^3 of the SO(3) and SE(3) exponentials
+    # Taylor expansions are used for small angles, where the closed forms lose precision
+    small = theta < 1e-4
+    t = np.where(small, 1, theta)
+    A = np.where(small, 1 - theta ** 2 / 6, np.sin(t) / t)
+    B = np.where(small, 0.5 - theta ** 2 / 24, (1 - np.cos(t)) / t ** 2)
+    C = np.where(small, 1 / 6 - theta ** 2 / 120, (t - np.sin(t)) / t ** 3)
+    return A, B, C
+
+def so3_exp(omega: np.ndarray) -> np.ndarray:
+    # Rotation matrices (..., 3, 3) of a stack of rotation vectors (..., 3), using the Rodrigues formula
+    theta = np.linalg.norm(omega, axis=-1)
+    A, B, _ = _so3_coefficients(theta)
+    K = skew(omega)
+    return np.eye(3) + A[..., None, None] * K + B[..., None, None] * (K @ K)
+
+def so3_log(R: np.ndarray) -> np.ndarray:
+    # Rotation vectors (..., 3) of a stack of rotation matrices (..., 3, 3), the inverse of so3_exp
+    vee = np.stack([R[..., 2, 1] - R[..., 1, 2], R[..., 0, 2] - R[..., 2, 0], R[..., 1, 0] - R[..., 0, 1]], axis=-1)
+    # atan2 stays accurate for small angles, where arccos of the trace does not
+    theta = np.arctan2(np.linalg.norm(vee, axis=-1) / 2, (np.trace(R, axis1=-2, axis2=-1) - 1) / 2)
+    small = theta < 1e-4
+    sin_theta = np.where(small, 1, np.sin(theta))
+    omega = vee * np.where(small, 0.5 + theta ** 2 / 12, theta / (2 * sin_theta))[..., None]
+    # Near pi the antisymmetric part vanishes, so the axis is taken from the symmetric part R + I = 2 a a^T instead
+    near_pi = theta > np.pi - 1e-3
+    if np.any(near_pi):
+        S = (R[near_pi] + np.eye(3)) / 2
+        column = np.argmax(np.diagonal(S, axis1=-2, axis2=-1), axis=-1)
+        axis = np.take_along_axis(S, column[:, None, None], axis=-1)[..., 0]
+        axis /= np.linalg.norm(axis, axis=-1, keepdims=True)
+        # Keep the sign consistent with the antisymmetric part when it is still informative
+        axis *= np.where(np.sum(axis * vee[near_pi], axis=-1) < 0, -1, 1)[..., None]
+        omega[near_pi] = axis * theta[near_pi][..., None]
+    return omega
+
+def se3_exp(xi: np.ndarray) -> np.ndarray:
+    # Rigid transforms (..., 4, 4) of a stack of twists (..., 6), ordered as rotation vector then translation part
+    omega, rho = xi[..., :3], xi[..., 3:]
+    theta = np.linalg.norm(omega, axis=-1)
+    A, B, C = _so3_coefficients(theta)
+    K = skew(omega)
+    K2 = K @ K
+    T = np.zeros(xi.shape[:-1] + (4, 4))
+    T[..., :3, :3] = np.eye(3) + A[..., None, None] * K + B[..., None, None] * K2
+    V = np.eye(3) + B[..., None, None] * K + C[..., None, None] * K2
+    T[..., :3, 3] = (V @ rho[..., None])[..., 0]
+    T[..., 3, 3] = 1
+    return T
+
+def se3_log(T: np.ndarray) -> np.ndarray:
+    # Twists (..., 6) of a stack of rigid transforms (..., 4, 4), the inverse of se3_exp
+    omega = so3_log(T[..., :3, :3])
+    theta = np.linalg.norm(omega, axis=-1)
+    A, B, _ = _so3_coefficients(theta)
+    small = theta < 1e-4
+    t = np.where(small, 1, theta)
+    D = np.where(small, 1 / 12 + theta ** 2 / 720, (1 - A / (2 * np.where(small, 1, B))) / t ** 2)
+    K = skew(omega)
+    V_inv = np.eye(3) - 0.5 * K + D[..., None, None] * (K @ K)
+    rho = (V_inv @ T[..., :3, 3, None])[..., 0]
+    return np.concatenate([omega, rho], axis=-1)
+
+def se3_adjoint(T: np.ndarray) -> np.ndarray:
+    # Adjoint matrices (..., 6, 6) of a stack of rigid transforms (..., 4, 4), such that T exp(xi) T^-1 = exp(Ad(T) xi) for twists in (omega, rho) order
+    R = T[..., :3, :3]
+    Ad = np.zeros(T.shape[:-2] + (6, 6))
+    Ad[..., :3, :3] = R
+    Ad[..., 3:, 3:] = R
+    Ad[..., 3:, :3] = skew(T[..., :3, 3]) @ R
+    return Ad
+
+def quaternion_multiply(q1: np.ndarray, q2: np.ndarray) -> np.ndarray:
+    # Hamilton products q1 * q2 of stacks of quaternions (..., 4) in (w, x, y, z) order
+    w1, v1 = q1[..., :1], q1[..., 1:]
+    w2, v2 = q2[..., :1], q2[..., 1:]
+    return np.concatenate([w1 * w2 - np.sum(v1 * v2, axis=-1, keepdims=True), w1 * v2 + w2 * v1 + np.cross(v1, v2)], axis=-1)
+
+def quaternion_rotate(q: np.ndarray, v: np.ndarray) -> np.ndarray:
+    # Rotate stacks of vectors (..., 3) by unit quaternions (..., 4) in (w, x, y, z) order, without building matrices
+    w, u = q[..., :1], q[..., 1:]
+    c = 2 * np.cross(u, v)
+    return v + w * c + np.cross(u, c)
+
+def matrices_to_poses(T: np.ndarray, dtype: np.dtype = np.float64) -> np.ndarray:
+    # Convert a stack of rigid transforms (..., 4, 4) to compact poses (..., 7), a (w, x, y, z) quaternion followed by the translation
+    poses = np.empty(T.shape[:-2] + (7,), dtype=dtype)
+    poses[..., :4] = rotation_to_quaternion(T[..., :3, :3])
+    poses[..., 4:] = T[..., :3, 3]
+    return poses
+
+def poses_to_matrices(poses: np.ndarray) -> np.ndarray:
+    # Convert a stack of compact poses (..., 7) to rigid transforms (..., 4, 4)
+    T = np.zeros(poses.shape[:-1] + (4, 4))
+    T[..., :3, :3] = quaternion_to_rotation(poses[..., :4])
+    T[..., :3, 3] = poses[..., 4:]
+    T[..., 3, 3] = 1
+    # Keep unsolved poses entirely nan, like unsolved matrices
+    T[np.isnan(poses).any(axis=-1)] = np.nan
+    return T
+
+def compose_poses(p1: np.ndarray, p2: np.ndarray) -> np.ndarray:
+    # Compose stacks of compact poses (..., 7), the equivalent of multiplying the matrices T1 @ T2
+    return np.concatenate([quaternion_multiply(p1[..., :4], p2[..., :4]), quaternion_rotate(p1[..., :4], p2[..., 4:]) + p1[..., 4:]], axis=-1)
+
+def invert_poses(poses: np.ndarray) -> np.ndarray:
+    # Invert a stack of compact poses (..., 7), using the conjugate quaternion and the rotated back translation
+    conjugate = poses[..., :4] * np.array([1, -1, -1, -1], dtype=poses.dtype)
+    return np.concatenate([conjugate, -quaternion_rotate(conjugate, poses[..., 4:])], axis=-1)
@@ -1,6 +1,7 @@
 import { TransformControls } from "@react-three/drei";
 import { Fragment, useEffect, useRef, useState } from "react";
 import { io, Socket } from "socket.io-client";
+import { Quaternion, Vector3 } from "three";
 import { z } from "zod";
 
 // 4x4 matrix, but all null
@@ -42,6 +43,19 @@ export const edgeMapSchema = z.record(
     )
 );
 
+// The edge table, sent once on connection before binary frames
+export const edgeTableSchema = z.object({
+    num_nodes: z.number(),
+    edges: z.array(
+        z.object({
+            from: z.number(),
+            to: z.number(),
+            type: z.union([z.literal("rigid-known"), z.literal("rigid-unknown"), z.literal("non-rigid-known"), z.literal("non-rigid-unknown")]),
+            noise: z.number().nullable(),
+        })
+    )
+});
+
 // The world state
 export const worldStateSchema = z.object({
     edges: edgeMapSchema,
@@ -57,6 +71,34 @@ export type WorldTransformMap = z.infer<typeof worldTransformMapSchema>;
 export type Transform = z.infer<typeof transformSchema>;
 export type SolvedTransform = z.infer<typeof solvedTransformSchema>;
 export type UnsolvedTransform = z.infer<typeof unsolvedTransformSchema>;
+export type EdgeTable = z.infer<typeof edgeTableSchema>;
+
+// Binary frame messages, see server/protocol.py for the layout
+export const EDGE_CHANNEL = 0;
+export const NODE_CHANNEL = 1;
+const HEADER_SIZE = 9;
+const RECORD_SIZE = 32;
+
+// Quaternion (w, x, y, z) followed by translation (x, y, z), all NaN if unsolved
+export type Pose = Float32Array;
+
+// Decode a frame message into the poses it updates, keyed by edge id or node id
+export function decodeFrame(buffer: ArrayBuffer): { channel: number, frame: number, poses: Record<number, Pose> } {
+    const view = new DataView(buffer);
+    const channel = view.getUint8(0);
+    const frame = view.getUint32(1, true);
+    const count = view.getUint32(5, true);
+    const poses: Record<number, Pose> = {};
+    for (let i = 0; i < count; i++) {
+        const offset = HEADER_SIZE + i * RECORD_SIZE;
+        const pose = new Float32Array(7);
+        for (let j = 0; j < 7; j++) {
+            pose[j] = view.getFloat32(offset + 4 + j * 4, true);
+        }
+        poses[view.getUint32(offset, true)] = pose;
+    }
+    return { channel, frame, poses };
+}
 
 const TestComponent = () => {
     console.log("Rendering");
@@ -90,22 +132,56 @@ function TransformVisualizer({transform, activeFrame=0}: {transform: SolvedTrans
     )
 }
 
+function PoseVisualizer({pose}: {pose: Pose}) {
+    const groupRef = useRef<THREE.Group>();
+    useEffect(() => {
+        groupRef.current?.matrix.compose(
+            new Vector3(pose[4], pose[5], pose[6]),
+            new Quaternion(pose[1], pose[2], pose[3], pose[0]),
+            new Vector3(1, 1, 1)
+        );
+    }, [pose]);
+    return (
+        <group ref={groupRef} matrixAutoUpdate={false}>
+            <TransformControls mode="translate" enabled={false} />
+        </group>
+    )
+}
+
 export function Scene() {
     // Create a state to hold the world state
     const [worldState, setWorldState] = useState<WorldState>();
+    // State received through the binary protocol
+    const [edgeTable, setEdgeTable] = useState<EdgeTable>();
+    const [nodePoses, setNodePoses] = useState<Record<number, Pose>>({});
     // Maintain a variable that holds the socket
     const socket = useRef<Socket>();
     // Initialize the socket
     useEffect(() => {
         socket.current = io("http://localhost:5000");
         console.log("Socket initialized")
-        // Listen for the "graph" event
-        socket.current.on("graph", (graph: WorldState) => {
+        // Listen for the "graph" event, which holds the graph encoded as a JSON string
+        socket.current.on("graph", (message: string) => {
+            const graph = JSON.parse(message);
             // Validate the graph
             console.log(graph);
             worldStateSchema.parse(graph);
             setWorldState(graph as WorldState);
         });
+        // Listen for the edge table, which resets the binary state
+        socket.current.on("edges", (table: EdgeTable) => {
+            edgeTableSchema.parse(table);
+            setEdgeTable(table);
+            setNodePoses({});
+        });
+        // Listen for binary frames, which only hold the poses that changed
+        // Only the node poses are drawn, edge poses are relative to their first node and are left to other clients
+        socket.current.on("frame", (buffer: ArrayBuffer) => {
+            const { channel, poses } = decodeFrame(buffer);
+            if (channel === NODE_CHANNEL) {
+                setNodePoses((previous) => ({ ...previous, ...poses }));
+            }
+        });
         // Clean up the socket when the component unmounts
         return () => {
             socket.current?.disconnect();
@@ -124,6 +200,13 @@ export function Scene() {
                     )
                 )
             }
+            {
+                edgeTable && (
+                    Object.entries(nodePoses).filter(([node, pose]) => !isNaN(pose[0])).map(([node, pose]) => (
+                        <PoseVisualizer key={node} pose={pose}/>
+                    ))
+                )
+            }
             <mesh scale={10} rotation={[Math.PI/2,0,0]}>
                 <planeGeometry args={[1, 1, 50, 50]}/>
                 <meshBasicMaterial wireframe color="black"/>